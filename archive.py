@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Moves old analytics records (messages and game_logs) out of the hot collections into monthly partitions,
+e.g. messages_2026_09, so that the hot collections and their indexes stay small enough to fit in RAM.
+The texts of the bot messages, which are mostly the same few long templates, are stored once in archive_texts
+and are referenced from the archived records by text_id.
+Archive.iter_documents reads hot and archived records together, with the texts restored.
+
+Run it regularly, e.g. daily with the Heroku scheduler:
+
+    python archive.py [--keep-days DAYS] [--collections NAME ...]
+"""
+import argparse
+import hashlib
+import logging
+import os
+
+from datetime import datetime, timedelta
+from export import iter_documents
+from indexes import INDEX_SPECS
+from pymongo import MongoClient, ReplaceOne
+from transactions import run_in_transaction
+
+logger = logging.getLogger(__name__)
+
+ARCHIVED_COLLECTIONS = ('messages', 'game_logs')
+# game_logs timestamps are written with datetime.now(), and messages timestamps with datetime.utcnow()
+CLOCKS = {'messages': datetime.utcnow, 'game_logs': datetime.now}
+PARTITIONS_ID = 'archive_partitions'
+TEXTS_ID = 'archive_texts'
+BATCH_SIZE = 1000
+
+
+def month_start(timestamp):
+    return datetime(timestamp.year, timestamp.month, 1)
+
+
+def next_month(start):
+    return datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+
+
+def partition_name(name, start):
+    return '{}_{:04d}_{:02d}'.format(name, start.year, start.month)
+
+
+def text_id(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+class Archive:
+    def __init__(self, db):
+        self.db = db
+        # _id (partition name), collection, month, count
+        self.partitions = db.get_collection(PARTITIONS_ID)
+        # _id (text_id), text
+        self.texts = db.get_collection(TEXTS_ID)
+        # text_id -> text; there are only a few dozen distinct bot texts
+        self.text_cache = {}
+
+    def sources(self, name, since=None, until=None):
+        """ The partitions of the collection that may have records in [since, until), oldest first, then the hot one """
+        query = {'collection': name}
+        if until is not None:
+            query['month'] = {'$lt': until}
+        partitions = [
+            p for p in self.partitions.find(query).sort('month', 1)
+            if since is None or next_month(p['month']) > since
+        ]
+        return [self.db.get_collection(p['_id']) for p in partitions] + [self.db.get_collection(name)]
+
+    def iter_documents(self, name, query=None, after_id=None, batch_size=500, limit=None, since=None, until=None):
+        """
+        Like export.iter_documents, but over the hot collection and all its partitions overlapping [since, until).
+        Records keep their _id when they are archived, so after_id works across the partitions.
+        """
+        returned = 0
+        for collection in self.sources(name, since=since, until=until):
+            remaining = None if limit is None else limit - returned
+            if remaining == 0:
+                return
+            for document in iter_documents(collection, query, after_id=after_id, batch_size=batch_size, limit=remaining):
+                returned += 1
+                yield self.expand(document)
+
+    def expand(self, document):
+        """ Put back the text of an archived bot message """
+        if 'text_id' in document:
+            key = document.pop('text_id')
+            if key not in self.text_cache:
+                stored = self.texts.find_one({'_id': key})
+                self.text_cache[key] = None if stored is None else stored['text']
+            document['text'] = self.text_cache[key]
+        return document
+
+    def compact(self, name, document):
+        """ Replace the text of a bot message with its text_id, storing the text if it is new """
+        if name != 'messages' or document.get('from_user') is not False or not document.get('text'):
+            return document
+        text = document.pop('text')
+        key = text_id(text)
+        if key not in self.text_cache:
+            self.texts.update_one({'_id': key}, {'$setOnInsert': {'text': text}}, upsert=True)
+            self.text_cache[key] = text
+        document['text_id'] = key
+        return document
+
+    def ensure_partition(self, name, start):
+        partition = partition_name(name, start)
+        if self.partitions.find_one({'_id': partition}) is None:
+            collection = self.db.get_collection(partition)
+            for keys, options in INDEX_SPECS.get(name, []):
+                collection.create_index(keys, **options)
+            self.partitions.update_one(
+                {'_id': partition}, {'$setOnInsert': {'collection': name, 'month': start, 'count': 0}}, upsert=True
+            )
+        return partition
+
+    def archive(self, name, cutoff, batch_size=BATCH_SIZE):
+        """ Move the records of the collection older than cutoff into the partitions; return their number """
+        hot = self.db.get_collection(name)
+        moved = 0
+        while True:
+            batch = list(hot.find({'timestamp': {'$lt': cutoff}}).sort('_id', 1).limit(batch_size))
+            if not batch:
+                return moved
+            by_partition = {}
+            for document in batch:
+                partition = self.ensure_partition(name, month_start(document['timestamp']))
+                by_partition.setdefault(partition, []).append(self.compact(name, document))
+
+            def move(session):
+                # each record is written to its partition and removed from the hot collection at once
+                for partition, documents in by_partition.items():
+                    self.db.get_collection(partition).bulk_write(
+                        [ReplaceOne({'_id': d['_id']}, d, upsert=True) for d in documents],
+                        ordered=False, session=session,
+                    )
+                    self.partitions.update_one({'_id': partition}, {'$inc': {'count': len(documents)}}, session=session)
+                hot.delete_many({'_id': {'$in': [d['_id'] for d in batch]}}, session=session)
+            run_in_transaction(self.db.client, move)
+            moved += len(batch)
+            logger.info('archived %s records of %s', moved, name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Move old messages and game logs into monthly partitions')
+    parser.add_argument('--keep-days', type=int, default=31, help='how many recent days stay in the hot collections')
+    parser.add_argument('--collections', nargs='+', default=list(ARCHIVED_COLLECTIONS), choices=ARCHIVED_COLLECTIONS)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    db = MongoClient(os.environ['MONGODB_URI']).get_default_database()
+    archive = Archive(db)
+    for name in args.collections:
+        moved = archive.archive(name, CLOCKS[name]() - timedelta(days=args.keep_days))
+        print('{}: {} records archived'.format(name, moved))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Broadcaster:
+    """
+    Sends a notification to many users from a background thread, outside the request that has triggered it.
+    Triggers that arrive while a broadcast is pending are merged into it,
+    and each recipient gets at most one notification per `window` seconds.
+    """
+    def __init__(self, fetch_recipients, send, window=10 * 60):
+        # fetch_recipients() returns user objects; send(user_object) enqueues the notification for one of them
+        self.fetch_recipients = fetch_recipients
+        self.send = send
+        self.window = window
+        self.last_sent = {}
+        self.excluded = set()
+        self.pending = False
+        self.condition = threading.Condition()
+        self.thread = None
+        self.sent = 0
+        self.suppressed = 0
+
+    def trigger(self, exclude_user_id=None):
+        with self.condition:
+            if exclude_user_id is not None:
+                self.excluded.add(exclude_user_id)
+            if self.pending:
+                return
+            self.pending = True
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='broadcast', daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+            try:
+                recipients = list(self.fetch_recipients())
+            except Exception:
+                logger.exception('failed to fetch the recipients of a broadcast')
+                recipients = []
+            with self.condition:
+                self.pending = False
+                excluded, self.excluded = self.excluded, set()
+            self._deliver(recipients, excluded)
+
+    def _deliver(self, recipients, excluded):
+        now = time.monotonic()
+        cutoff = now - self.window
+        self.last_sent = {user_id: sent_at for user_id, sent_at in self.last_sent.items() if sent_at > cutoff}
+        for user_object in recipients:
+            user_id = user_object['user_id']
+            if user_id in excluded or user_id in self.last_sent:
+                self.suppressed += 1
+                continue
+            self.last_sent[user_id] = now
+            try:
+                self.send(user_object)
+                self.sent += 1
+            except Exception:
+                logger.exception('failed to notify user %s', user_id)
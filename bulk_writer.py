@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+MODE_ASYNC = 'async'
+MODE_SYNC = 'sync'
+
+
+class BufferedWriter:
+    """
+    Write-behind pipeline for append-only collections (messages, game logs).
+    In the async mode, documents are buffered per collection and written with insert_many
+    by a background thread, whenever a buffer reaches flush_size or every flush_interval seconds.
+    In the sync mode, every document is inserted immediately, as before.
+    """
+    def __init__(self, mode=MODE_ASYNC, flush_size=200, flush_interval=1.0, max_buffer=100000):
+        if mode not in {MODE_ASYNC, MODE_SYNC}:
+            raise ValueError('Unknown write mode "{}"'.format(mode))
+        self.mode = mode
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        # collection full name -> (collection, list of documents)
+        self.buffers = {}
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.thread = None
+        self.stopped = False
+
+    def insert(self, collection, document):
+        self.insert_many([(collection, document)])
+
+    def insert_many(self, pairs):
+        """ Add several (collection, document) pairs at once, so that they are flushed in the same batch """
+        if self.mode == MODE_SYNC:
+            for collection, document in pairs:
+                collection.insert_one(document)
+            return
+        if self.thread is None:
+            self._start()
+        with self.condition:
+            for collection, document in pairs:
+                buffer = self.buffers.setdefault(collection.full_name, (collection, []))[1]
+                buffer.append(document)
+                if len(buffer) >= self.flush_size:
+                    self.condition.notify()
+
+    def pending(self):
+        with self.condition:
+            return sum(len(documents) for _, documents in self.buffers.values())
+
+    def flush(self):
+        with self.flush_lock:
+            with self.condition:
+                batches = [(collection, documents) for collection, documents in self.buffers.values() if documents]
+                self.buffers = {}
+            for collection, documents in batches:
+                try:
+                    collection.insert_many(documents, ordered=False)
+                except BulkWriteError as exc:
+                    # the rest of the batch has been written; retrying it would only produce duplicates
+                    logger.warning('some documents for %s were rejected: %s', collection.name, exc.details)
+                except Exception:
+                    logger.exception('failed to write %s documents to %s', len(documents), collection.name)
+                    self._requeue(collection, documents)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join(timeout=10)
+            self.thread = None
+        self.flush()
+
+    def _requeue(self, collection, documents):
+        with self.condition:
+            buffer = self.buffers.setdefault(collection.full_name, (collection, []))[1]
+            buffer[:0] = documents
+            if len(buffer) > self.max_buffer:
+                logger.error('dropping %s documents for %s', len(buffer) - self.max_buffer, collection.name)
+                del buffer[:len(buffer) - self.max_buffer]
+
+    def _start(self):
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='bulk-writer', daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                if not self.stopped and all(len(docs) < self.flush_size for _, docs in self.buffers.values()):
+                    self.condition.wait(self.flush_interval)
+                stopped = self.stopped
+            self.flush()
+            if stopped:
+                return
@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Builds the dialogue corpus: groups the flat game_logs rows into one transcript document per game.
+Each run processes only the games that got new log events since the previous run (the high-watermark),
+so a nightly refresh does not rescan the whole history.
+
+    python corpus.py [--jsonl DIR] [--full]
+"""
+import argparse
+import os
+
+from archive import Archive
+from bson.json_util import dumps
+from datetime import datetime, timedelta
+from pymongo import MongoClient, ReplaceOne
+
+EVENT_START = 'game_start'
+EVENT_TEXT = 'text'
+EVENT_MEDIA = 'media'
+EVENTS_END = {
+    'game_end_by_seller': 'no_deal_by_seller',
+    'game_end_by_buyer_did_buy': 'deal',
+    'game_end_by_buyer_did_not_buy': 'no_deal_by_buyer',
+    'game_timeout': 'timeout',
+}
+EVENTS_FEEDBACK = {'feedback_terms': 'terms', 'feedback_why_not': 'why_not'}
+
+STATE_ID = 'transcripts'
+CHUNK_SIZE = 500
+# game logs are written in background batches, so the most recent events may still be on their way
+WATERMARK_LAG = timedelta(minutes=5)
+
+
+def get_watermark(state_collection):
+    state = state_collection.find_one({'_id': STATE_ID})
+    return None if state is None else state['watermark']
+
+
+def find_touched_games(sources, since, until):
+    """ Ids of the games that have got any log events in (since, until], in any of the game_logs collections """
+    time_filter = {'$lte': until}
+    if since is not None:
+        time_filter['$gt'] = since
+    pipeline = [
+        {'$match': {'timestamp': time_filter, 'game_id': {'$ne': None}}},
+        {'$group': {'_id': '$game_id'}},
+    ]
+    game_ids = set()
+    for game_logs in sources:
+        game_ids.update(row['_id'] for row in game_logs.aggregate(pipeline))
+    return sorted(game_ids)
+
+
+def group_game_events(sources, game_ids):
+    """ The events of each game in the order of time, collected from all the game_logs collections """
+    pipeline = [
+        {'$match': {'game_id': {'$in': game_ids}}},
+        {'$sort': {'timestamp': 1, '_id': 1}},
+        {'$group': {'_id': '$game_id', 'events': {'$push': {
+            'event': '$event', 'sender': '$sender', 'receiver': '$receiver', 'sender_role': '$sender_role',
+            'text': '$text', 'timestamp': '$timestamp',
+            # only media events have content_type; mongomock drops the rows with a missing pushed field
+            'content_type': {'$ifNull': ['$content_type', None]},
+        }}}},
+    ]
+    games = {}
+    for game_logs in sources:
+        for row in game_logs.aggregate(pipeline):
+            games.setdefault(row['_id'], []).extend(row['events'])
+    for game_id, events in games.items():
+        # a game that spans the end of a month has its events in two partitions
+        events.sort(key=lambda event: event['timestamp'])
+        yield game_id, events
+
+
+def build_transcript(game_id, events):
+    """ Turn the ordered events of one game into a transcript, or return None if the game has not finished yet """
+    transcript = {
+        '_id': game_id, 'players': {}, 'started_at': None, 'turns': [], 'end': None, 'outcome': None,
+        'feedback': {'terms': [], 'why_not': []},
+    }
+    for event in events:
+        name = event['event']
+        if name == EVENT_START:
+            transcript['started_at'] = event['timestamp']
+            transcript['players'][event['sender_role']] = event['sender']
+            other_role = 'buyer' if event['sender_role'] == 'seller' else 'seller'
+            transcript['players'][other_role] = event['receiver']
+        elif name in (EVENT_TEXT, EVENT_MEDIA):
+            # a media turn (a sticker, a photo etc.) has no text, only the type of its content
+            transcript['turns'].append({
+                'sender': event['sender'], 'role': event['sender_role'], 'text': event['text'],
+                'content_type': 'text' if name == EVENT_TEXT else event['content_type'],
+                'timestamp': event['timestamp'],
+            })
+        elif name in EVENTS_END:
+            transcript['end'] = {'event': name, 'sender': event['sender'], 'timestamp': event['timestamp']}
+            transcript['outcome'] = EVENTS_END[name]
+        elif name in EVENTS_FEEDBACK:
+            transcript['feedback'][EVENTS_FEEDBACK[name]].append({
+                'sender': event['sender'], 'role': event['sender_role'], 'text': event['text'],
+            })
+    if transcript['end'] is None:
+        return None
+    return transcript
+
+
+def build_corpus(db, jsonl_dir=None, full=False):
+    # the hot game_logs and its archived partitions
+    archive = Archive(db)
+    transcripts = db.get_collection('transcripts')
+    state_collection = db.get_collection('corpus_state')
+
+    since = None if full else get_watermark(state_collection)
+    # game_logs timestamps are written with datetime.now()
+    until = datetime.now() - WATERMARK_LAG
+    game_ids = find_touched_games(archive.sources('game_logs', since=since, until=until), since, until)
+    sources = archive.sources('game_logs')
+    print('{} games have new events since {}'.format(len(game_ids), since))
+
+    shard = None
+    if jsonl_dir is not None and game_ids:
+        os.makedirs(jsonl_dir, exist_ok=True)
+        shard = open(os.path.join(jsonl_dir, 'transcripts-{}.jsonl'.format(until.strftime('%Y%m%d-%H%M%S'))), 'w')
+    built = 0
+    try:
+        for start in range(0, len(game_ids), CHUNK_SIZE):
+            requests = []
+            for game_id, events in group_game_events(sources, game_ids[start:start + CHUNK_SIZE]):
+                transcript = build_transcript(game_id, events)
+                if transcript is None:
+                    continue
+                requests.append(ReplaceOne({'_id': game_id}, transcript, upsert=True))
+                if shard is not None:
+                    shard.write(dumps(transcript, ensure_ascii=False) + '\n')
+            if requests:
+                transcripts.bulk_write(requests, ordered=False)
+                built += len(requests)
+    finally:
+        if shard is not None:
+            shard.close()
+    # the watermark moves only after all the transcripts have been written
+    state_collection.update_one({'_id': STATE_ID}, {'$set': {'watermark': until}}, upsert=True)
+    print('{} finished games written to transcripts'.format(built))
+    return built
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the dialogue corpus from game logs')
+    parser.add_argument('--jsonl', help='also write the new transcripts as a JSONL shard into this directory')
+    parser.add_argument('--full', action='store_true', help='ignore the watermark and rebuild all transcripts')
+    args = parser.parse_args()
+
+    db = MongoClient(os.environ['MONGODB_URI']).get_default_database()
+    build_corpus(db, jsonl_dir=args.jsonl, full=args.full)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+from collections import OrderedDict
+from datetime import datetime
+from pymongo.errors import DuplicateKeyError
+
+# the TTL index on the shared collection is created with the same value in indexes.py
+DEDUP_TTL = 24 * 60 * 60
+
+
+class UpdateDeduplicator:
+    """
+    Remembers which updates have already been processed, so that webhook retries are not processed twice.
+    The in-memory tier is an LRU with a TTL and a fixed number of keys.
+    The optional Mongo tier is shared by all workers; its TTL index (see indexes.py) removes old keys.
+    """
+    def __init__(self, collection=None, max_size=50000, ttl=DEDUP_TTL):
+        self.collection = collection
+        self.max_size = max_size
+        self.ttl = ttl
+        self.keys = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def message_key(msg):
+        # message_id is unique only within a chat
+        return '{}:{}'.format(msg.chat.id, msg.message_id)
+
+    def is_duplicate(self, key):
+        """ Mark the key as processed; return True if it has already been marked before """
+        now = time.monotonic()
+        with self.lock:
+            expires_at = self.keys.get(key)
+            if expires_at is not None and expires_at > now:
+                return True
+            self.keys[key] = now + self.ttl
+            self.keys.move_to_end(key)
+            while len(self.keys) > self.max_size:
+                self.keys.popitem(last=False)
+        if self.collection is not None:
+            try:
+                self.collection.insert_one({'_id': key, 'created_at': datetime.utcnow()})
+            except DuplicateKeyError:
+                return True
+            except Exception:
+                # the update will not be processed now, so a redelivery of it must not be taken for a duplicate
+                with self.lock:
+                    self.keys.pop(key, None)
+                raise
+        return False
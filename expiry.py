@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import heapq
+import logging
+import threading
+import time
+
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class ExpiryScheduler:
+    """
+    Calls expire(key) for every key that has not been touched for `timeout` seconds.
+    The deadlines are kept in a min-heap with at most one entry per key: a touch only moves the deadline in a dict,
+    and an entry that comes out of the heap with an outdated deadline is pushed back with the actual one,
+    so each touch is O(1), each expiry is O(log n), and nothing ever scans all the keys.
+    The last activity is also handed to persist(key, datetime), at most once per persist_interval seconds per key,
+    so that the deadlines can be recovered after a restart with recover().
+    """
+    def __init__(self, timeout, expire, persist=None, persist_interval=60, name='expiry'):
+        self.timeout = timeout
+        self.expire = expire
+        self.persist = persist
+        self.persist_interval = persist_interval
+        self.name = name
+        # key -> monotonic deadline, for the keys being tracked
+        self.deadlines = {}
+        # heap of (deadline, key); a key is in `scheduled` iff it has an entry in the heap
+        self.heap = []
+        self.scheduled = set()
+        # key -> monotonic time of the last persisted activity
+        self.persisted = {}
+        self.condition = threading.Condition()
+        self.thread = None
+        self.expired = 0
+
+    def start(self):
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self.thread.start()
+
+    def touch(self, key, last_activity=None, persist=True):
+        """ Register activity of key: now, or at the datetime last_activity (e.g. read from the database) """
+        now = time.monotonic()
+        if last_activity is None:
+            activity = now
+        else:
+            activity = now - (datetime.utcnow() - last_activity).total_seconds()
+        if self.thread is None:
+            self.start()
+        with self.condition:
+            if activity + self.timeout <= self.deadlines.get(key, float('-inf')):
+                return
+            self.deadlines[key] = activity + self.timeout
+            if key not in self.scheduled:
+                self.scheduled.add(key)
+                heapq.heappush(self.heap, (activity + self.timeout, key))
+                self.condition.notify()
+            need_persist = persist and self.persist is not None and \
+                now - self.persisted.get(key, float('-inf')) >= self.persist_interval
+            if need_persist:
+                self.persisted[key] = now
+        if need_persist:
+            try:
+                self.persist(key, datetime.utcnow())
+            except Exception:
+                logger.exception('failed to persist the activity of %s in %s', key, self.name)
+
+    def cancel(self, key):
+        with self.condition:
+            # the heap entry stays and is dropped when it comes out
+            self.deadlines.pop(key, None)
+            self.persisted.pop(key, None)
+
+    def recover(self, items):
+        """ Track the keys from (key, last_activity) pairs, e.g. after a restart """
+        count = 0
+        for key, last_activity in items:
+            self.touch(key, last_activity=last_activity, persist=False)
+            count += 1
+        logger.info('%s: recovered %s keys', self.name, count)
+
+    def pending(self):
+        with self.condition:
+            return len(self.deadlines)
+
+    def _next_expired(self):
+        with self.condition:
+            while True:
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                deadline, key = self.heap[0]
+                now = time.monotonic()
+                if deadline > now:
+                    self.condition.wait(deadline - now)
+                    continue
+                heapq.heappop(self.heap)
+                actual = self.deadlines.get(key)
+                if actual is None:
+                    self.scheduled.discard(key)
+                elif actual > deadline:
+                    heapq.heappush(self.heap, (actual, key))
+                else:
+                    self.scheduled.discard(key)
+                    del self.deadlines[key]
+                    self.persisted.pop(key, None)
+                    return key
+
+    def _run(self):
+        while True:
+            key = self._next_expired()
+            self.expired += 1
+            try:
+                self.expire(key)
+            except Exception:
+                logger.exception('failed to expire %s in %s', key, self.name)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+import hmac
+import zlib
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from bson.json_util import dumps
+from datetime import datetime
+from flask import Blueprint, Response, abort, request
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+def build_query(since=None, until=None, game_id=None, user_id=None, user_field='user_id'):
+    query = {}
+    if since is not None or until is not None:
+        query['timestamp'] = {}
+        if since is not None:
+            query['timestamp']['$gte'] = since
+        if until is not None:
+            query['timestamp']['$lt'] = until
+    if game_id is not None:
+        query['game_id'] = game_id
+    if user_id is not None:
+        query[user_field] = user_id
+    return query
+
+
+def iter_documents(collection, query=None, after_id=None, batch_size=500, limit=None):
+    """
+    Iterate over the documents in the order of _id, fetching them in batches of batch_size.
+    Memory use does not depend on the size of the collection, and the iteration
+    can be resumed from any document by passing its _id as after_id.
+    """
+    query = dict(query or {})
+    returned = 0
+    while limit is None or returned < limit:
+        if after_id is not None:
+            query['_id'] = {'$gt': after_id}
+        size = batch_size if limit is None else min(batch_size, limit - returned)
+        batch = list(collection.find(query).sort('_id', 1).limit(size))
+        if not batch:
+            return
+        for document in batch:
+            yield document
+        returned += len(batch)
+        after_id = batch[-1]['_id']
+
+
+def parse_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        return ObjectId(cursor)
+    except (InvalidId, TypeError):
+        return None
+
+
+def render_logs_page(collection, cursor=None, page_size=20):
+    """ Render documents that fit into one Telegram message; return the text and the cursor of the next page """
+    lines = []
+    length = 0
+    last_id = None
+    for document in iter_documents(collection, after_id=parse_cursor(cursor), batch_size=page_size, limit=page_size):
+        line = str(document)[:TELEGRAM_MESSAGE_LIMIT // 2]
+        if length + len(line) + 100 > TELEGRAM_MESSAGE_LIMIT:
+            return '\n'.join(lines), str(last_id)
+        lines.append(line)
+        length += len(line) + 1
+        last_id = document['_id']
+    if len(lines) == page_size:
+        return '\n'.join(lines), str(last_id)
+    return '\n'.join(lines), None
+
+
+def _generate_ndjson(documents, compress=False):
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    for document in documents:
+        line = (dumps(document, ensure_ascii=False) + '\n').encode('utf-8')
+        if compressor is None:
+            yield line
+        else:
+            chunk = compressor.compress(line)
+            if chunk:
+                yield chunk
+    if compressor is not None:
+        yield compressor.flush()
+
+
+def _parse_time(value):
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        abort(400, 'Could not parse time "{}"'.format(value))
+
+
+def make_export_blueprint(collections, token, archive=None):
+    """
+    /export/<name>?since=...&until=...&game_id=...&cursor=...&limit=...&gzip=1 streams NDJSON of a collection.
+    Every line contains the _id of the document, which can be passed as the cursor to resume the export.
+    The export is available only if a token is configured; it is passed as "Authorization: Bearer <token>".
+    If an archive.Archive is given, the archived records of the collection are exported too.
+    """
+    blueprint = Blueprint('export', __name__)
+
+    @blueprint.route('/export/<name>')
+    def export_collection(name):
+        auth = request.headers.get('Authorization', '')
+        if not token or not hmac.compare_digest(auth, 'Bearer ' + token):
+            abort(403)
+        if name not in collections:
+            abort(404)
+        since = _parse_time(request.args.get('since'))
+        until = _parse_time(request.args.get('until'))
+        query = build_query(since=since, until=until, game_id=request.args.get('game_id'))
+        limit = request.args.get('limit', type=int)
+        after_id = parse_cursor(request.args.get('cursor'))
+        if archive is not None:
+            documents = archive.iter_documents(name, query, after_id=after_id, limit=limit, since=since, until=until)
+        else:
+            documents = iter_documents(collections[name], query, after_id=after_id, limit=limit)
+        compress = request.args.get('gzip') in {'1', 'true'}
+        headers = {'Content-Encoding': 'gzip'} if compress else {}
+        return Response(_generate_ndjson(documents, compress=compress), mimetype='application/x-ndjson', headers=headers)
+
+    return blueprint
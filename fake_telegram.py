@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+A local stand-in for the Telegram Bot API, for load tests and replays.
+It records every call, answers like the real API, and can add latency and 429 errors.
+
+    api = FakeTelegramApi(latency=0.05, error_rate=0.01).start()
+    telebot.apihelper.API_URL = api.api_url
+"""
+import itertools
+import json
+import random
+import threading
+import time
+
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+
+class FakeTelegramApi:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0, retry_after=1):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.calls = []
+        self.call_counts = defaultdict(int)
+        self.errors_sent = 0
+        # chat_id -> list of dicts with the sent messages
+        self.messages = defaultdict(list)
+        self.updates = []
+        self.message_ids = itertools.count(1)
+        self.condition = threading.Condition()
+        self.server = ThreadingHTTPServer((host, port), self._make_handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def api_url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}/bot{{0}}/{{1}}'.format(host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='fake-telegram', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def push_update(self, update):
+        """ Make an update (a dict) available to getUpdates """
+        with self.condition:
+            self.updates.append(update)
+            self.condition.notify_all()
+
+    def wait_for_message(self, chat_id, predicate, start=0, timeout=10):
+        """ Wait until a message to the chat with index >= start satisfies the predicate; return (index, message) """
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                chat_messages = self.messages[chat_id]
+                for index in range(start, len(chat_messages)):
+                    if predicate(chat_messages[index]):
+                        return index, chat_messages[index]
+                start = len(chat_messages)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None, None
+                self.condition.wait(remaining)
+
+    def handle(self, method, params):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.condition:
+            self.calls.append((time.time(), method, params))
+            self.call_counts[method] += 1
+            if method in {'sendMessage', 'copyMessage'} and self.error_rate and random.random() < self.error_rate:
+                self.errors_sent += 1
+                return 429, {
+                    'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after {}'.format(
+                        self.retry_after
+                    ),
+                    'parameters': {'retry_after': self.retry_after},
+                }
+            result = self._result(method, params)
+            self.condition.notify_all()
+        return 200, {'ok': True, 'result': result}
+
+    def _result(self, method, params):
+        if method in {'sendMessage', 'copyMessage'}:
+            chat_id = int(params['chat_id'])
+            message = {
+                'message_id': next(self.message_ids), 'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': {'id': 1, 'is_bot': True, 'first_name': 'bot'},
+                'text': params.get('text'),
+            }
+            self.messages[chat_id].append(dict(message, method=method, params=params))
+            if method == 'copyMessage':
+                return {'message_id': message['message_id']}
+            return message
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'bot', 'username': 'fake_bot'}
+        if method == 'getWebhookInfo':
+            return {'url': '', 'has_custom_certificate': False, 'pending_update_count': len(self.updates)}
+        if method == 'getUpdates':
+            offset = int(params.get('offset') or 0)
+            limit = int(params.get('limit') or 100)
+            # long polling: wait for new updates for up to `timeout` seconds
+            deadline = time.monotonic() + float(params.get('timeout') or 0)
+            while True:
+                self.updates = [update for update in self.updates if update['update_id'] >= offset]
+                remaining = deadline - time.monotonic()
+                if self.updates or remaining <= 0:
+                    return self.updates[:limit]
+                self.condition.wait(remaining)
+        return True
+
+    def _make_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self._respond()
+
+            def do_GET(self):
+                self._respond()
+
+            def _respond(self):
+                url = urlparse(self.path)
+                method = url.path.rstrip('/').split('/')[-1]
+                params = dict(parse_qsl(url.query))
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    body = self.rfile.read(length).decode('utf-8')
+                    if self.headers.get('Content-Type', '').startswith('application/json'):
+                        params.update(json.loads(body))
+                    else:
+                        params.update(parse_qsl(body))
+                status, payload = api.handle(method, params)
+                data = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
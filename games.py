@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from datetime import datetime
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+GAME_IN_PROGRESS = 'in_progress'
+GAME_FINISHED = 'finished'
+
+
+class TransitionConflict(Exception):
+    """ The state has been changed by a concurrent request since it was read """
+
+
+class GameStore:
+    """
+    One document per game, with a version that is incremented by every transition.
+    A transition is applied only to the version it was decided on, so out of two concurrent
+    transitions of the same game (e.g. both players ending it at once) exactly one succeeds.
+    """
+    def __init__(self, collection, max_retries=3):
+        # _id (game_id), players ({role: user_id}), state, outcome, ended_by, version, created_at, updated_at,
+        # last_activity (persisted with some lag, see touch())
+        self.collection = collection
+        self.max_retries = max_retries
+
+    def create(self, game_id, players, session=None):
+        now = datetime.utcnow()
+        self.collection.insert_one({
+            '_id': game_id,
+            'players': players,
+            'state': GAME_IN_PROGRESS,
+            'version': 1,
+            'created_at': now,
+            'updated_at': now,
+            'last_activity': now,
+        }, session=session)
+
+    def touch(self, game_id, when):
+        """ Record activity in a game; does not change its version, as it is not a transition """
+        self.collection.update_one(
+            {'_id': game_id, 'state': GAME_IN_PROGRESS}, {'$max': {'last_activity': when}}
+        )
+
+    def iter_activity(self):
+        """ (game_id, last_activity) of all the games in progress """
+        for game in self.collection.find({'state': GAME_IN_PROGRESS}, {'last_activity': 1, 'created_at': 1}):
+            yield game['_id'], game.get('last_activity') or game['created_at']
+
+    def get(self, game_id, session=None):
+        return self.collection.find_one({'_id': game_id}, session=session)
+
+    def transition(self, game_id, from_state, set_fields, session=None):
+        """
+        Move the game from from_state, updating set_fields; return the new document.
+        Raise TransitionConflict if the game is no longer in from_state.
+        Return None for games started before the games collection existed.
+        """
+        for _ in range(self.max_retries):
+            game = self.get(game_id, session=session)
+            if game is None:
+                return None
+            if game['state'] != from_state:
+                raise TransitionConflict('game {} is {}, not {}'.format(game_id, game['state'], from_state))
+            updated = self.collection.find_one_and_update(
+                {'_id': game_id, 'version': game['version']},
+                {'$set': dict(set_fields, updated_at=datetime.utcnow()), '$inc': {'version': 1}},
+                return_document=ReturnDocument.AFTER,
+                session=session,
+            )
+            if updated is not None:
+                return updated
+            logger.info('version conflict on game %s, retrying', game_id)
+        raise TransitionConflict('game {} is changing too often'.format(game_id))
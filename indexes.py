@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from dedup import DEDUP_TTL
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure
+from user_cache import INVALIDATIONS_TTL
+
+logger = logging.getLogger(__name__)
+
+# collection name -> list of (keys, options); each index matches a query shape used by the bot
+INDEX_SPECS = {
+    'users': [
+        ([('user_id', ASCENDING)], {'unique': True}),
+        ([('current_state', ASCENDING)], {}),
+        # find_subscribed_users
+        ([('allow_notifications', ASCENDING), ('current_state', ASCENDING)], {}),
+    ],
+    'game_logs': [
+        ([('game_id', ASCENDING), ('timestamp', ASCENDING)], {}),
+        ([('sender', ASCENDING), ('timestamp', ASCENDING)], {}),
+        ([('timestamp', ASCENDING)], {}),
+    ],
+    'messages': [
+        ([('user_id', ASCENDING), ('timestamp', ASCENDING)], {}),
+        ([('timestamp', ASCENDING)], {}),
+    ],
+    'waiting_players': [
+        ([('user_id', ASCENDING)], {'unique': True}),
+        ([('enqueued_at', ASCENDING)], {}),
+    ],
+    'games': [
+        # the games in progress, when the expiry scheduler recovers after a restart
+        ([('state', ASCENDING), ('last_activity', ASCENDING)], {}),
+    ],
+    'processed_updates': [
+        ([('created_at', ASCENDING)], {'expireAfterSeconds': DEDUP_TTL}),
+    ],
+    'user_cache_invalidations': [
+        ([('created_at', ASCENDING)], {'expireAfterSeconds': INVALIDATIONS_TTL}),
+    ],
+}
+
+
+def _key_of(index_keys):
+    return tuple((field, int(direction)) for field, direction in index_keys)
+
+
+def get_unused_indexes(collection):
+    """ Names of indexes that have not served a single operation since the server start (None if unknown) """
+    try:
+        stats = list(collection.aggregate([{'$indexStats': {}}]))
+    except Exception:
+        # e.g. mongomock does not support $indexStats
+        return None
+    return sorted(s['name'] for s in stats if s['name'] != '_id_' and s.get('accesses', {}).get('ops', 0) == 0)
+
+
+def ensure_indexes(db, specs=None):
+    """
+    Create all missing indexes from the specs, and report what was missing,
+    which existing indexes are not in the specs, and which indexes are not used at all.
+    """
+    report = {}
+    for collection_name, collection_specs in (specs or INDEX_SPECS).items():
+        collection = db.get_collection(collection_name)
+        existing = {_key_of(info['key']): name for name, info in collection.index_information().items()}
+        expected = set()
+        missing = []
+        for keys, options in collection_specs:
+            key = _key_of(keys)
+            expected.add(key)
+            if key not in existing:
+                try:
+                    missing.append(collection.create_index(keys, **options))
+                except OperationFailure as exc:
+                    # e.g. duplicates prevent a unique index; the bot still works, only slower
+                    logger.error('failed to create index %s on %s: %s', keys, collection_name, exc)
+        extra = sorted(name for key, name in existing.items() if key not in expected and name != '_id_')
+        report[collection_name] = {'created': missing, 'extra': extra, 'unused': get_unused_indexes(collection)}
+        logger.info(
+            'indexes of %s: created %s, not in specs %s, unused %s',
+            collection_name, missing, extra, report[collection_name]['unused'],
+        )
+    return report
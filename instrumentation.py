@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + '}'
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} {}'.format(self.name, self.kind)]
+        lines.extend(self._render_samples())
+        return '\n'.join(lines)
+
+    def _render_samples(self):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def _render_samples(self):
+        with self.lock:
+            values = dict(self.values)
+        return ['{}{} {}'.format(self.name, _format_labels(self.labelnames, k), v) for k, v in sorted(values.items())]
+
+
+class Gauge(Metric):
+    """ A gauge whose values are computed by a function at scrape time; it returns {label values tuple: value} """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, function, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def _render_samples(self):
+        try:
+            values = self.function()
+        except Exception:
+            logging.getLogger(__name__).exception('failed to compute gauge %s', self.name)
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return ['{}{} {}'.format(self.name, _format_labels(self.labelnames, k), v) for k, v in sorted(values.items())]
+
+
+class CallbackCounter(Gauge):
+    """ A counter whose values are read by a function at scrape time, e.g. from the attributes of another object """
+    kind = 'counter'
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # label values -> [counts per bucket..., sum, count]
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+                    break
+            state[-2] += value
+            state[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _render_samples(self):
+        with self.lock:
+            values = {key: list(state) for key, state in self.values.items()}
+        lines = []
+        for key, state in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, _format_labels(self.labelnames, key, [('le', bound)]), cumulative
+                ))
+            lines.append('{}_bucket{} {}'.format(self.name, _format_labels(self.labelnames, key, [('le', '+Inf')]), state[-1]))
+            lines.append('{}_sum{} {}'.format(self.name, _format_labels(self.labelnames, key), state[-2]))
+            lines.append('{}_count{} {}'.format(self.name, _format_labels(self.labelnames, key), state[-1]))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def callback_counter(self, *args, **kwargs):
+        return self.register(CallbackCounter(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in self.metrics) + '\n'
+
+
+class TimedCursor:
+    """
+    Wraps a cursor returned by find or aggregate, which queries the database lazily, when it is iterated.
+    The time of the call and of the iteration is observed as one sample, once the cursor is exhausted or closed.
+    """
+    def __init__(self, cursor, histogram, labels, elapsed):
+        self._cursor = cursor
+        self._histogram = histogram
+        self._labels = labels
+        self._elapsed = elapsed
+        self._observed = False
+
+    def __getattr__(self, name):
+        attribute = getattr(self._cursor, name)
+        if not callable(attribute):
+            return attribute
+
+        def method(*args, **kwargs):
+            result = attribute(*args, **kwargs)
+            # sort, limit, skip etc. return the cursor itself, so that the calls can be chained
+            return self if result is self._cursor else result
+        return method
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            document = next(self._cursor)
+        except StopIteration:
+            self._elapsed += time.perf_counter() - started
+            self._observe()
+            raise
+        self._elapsed += time.perf_counter() - started
+        return document
+
+    def __getitem__(self, index):
+        return self._cursor[index]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._observe()
+        self._cursor.close()
+
+    def __del__(self):
+        self._observe()
+
+    def _observe(self):
+        if not self._observed:
+            self._observed = True
+            self._histogram.observe(self._elapsed, **self._labels)
+
+
+class InstrumentedCollection:
+    """ Wraps a Mongo collection and times every call of its methods, including the iteration of the cursors """
+    CURSOR_METHODS = frozenset(['find', 'aggregate'])
+
+    def __init__(self, collection, histogram):
+        self._collection = collection
+        self._histogram = histogram
+
+    def __getattr__(self, name):
+        attribute = getattr(self._collection, name)
+        if not callable(attribute):
+            return attribute
+        histogram = self._histogram
+        labels = {'collection': self._collection.name, 'method': name}
+        if name in self.CURSOR_METHODS:
+            def cursor_method(*args, **kwargs):
+                started = time.perf_counter()
+                cursor = attribute(*args, **kwargs)
+                return TimedCursor(cursor, histogram, labels, time.perf_counter() - started)
+            return cursor_method
+
+        def timed_method(*args, **kwargs):
+            with histogram.time(**labels):
+                return attribute(*args, **kwargs)
+        return timed_method
+
+
+def setup_logging(level='INFO'):
+    """
+    Send all log records through a queue to a background thread, which writes them to stderr,
+    so that the request threads never wait for console I/O.
+    """
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(level)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,262 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Load test of the bot: N simulated players subscribe, start games, chat, buy or decline, and give feedback.
+Updates are posted to the real Flask webhook of main.py; Telegram is replaced with FakeTelegramApi,
+and Mongo is mongomock (or a local mongod, if --mongo is given).
+
+    python loadtest.py --players 50 --games 3 --latency 0.05 --error-rate 0.01 --output results.json
+"""
+import argparse
+import functools
+import itertools
+import json
+import os
+import random
+import threading
+import time
+
+from collections import defaultdict
+from fake_telegram import FakeTelegramApi
+
+MONGO_METHODS = [
+    'find', 'find_one', 'insert_one', 'insert_many', 'update_one', 'update_many', 'replace_one', 'delete_one',
+    'find_one_and_update', 'find_one_and_delete', 'bulk_write', 'aggregate', 'count_documents',
+]
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def summarize(values):
+    return {
+        'count': len(values),
+        'p50': percentile(values, 50), 'p95': percentile(values, 95), 'p99': percentile(values, 99),
+        'max': max(values) if values else None,
+    }
+
+
+class MongoOpCounter:
+    """ Counts the calls of the collection methods, by wrapping them on the collection class """
+    def __init__(self, collection_class):
+        self.collection_class = collection_class
+        self.counts = defaultdict(int)
+        self.lock = threading.Lock()
+        self.originals = {}
+        # mongomock implements some methods through the others, so only the outermost call is counted
+        self.local = threading.local()
+
+    def install(self):
+        for name in MONGO_METHODS:
+            original = getattr(self.collection_class, name, None)
+            if original is None:
+                continue
+            self.originals[name] = original
+            setattr(self.collection_class, name, self._wrap(name, original))
+
+    def uninstall(self):
+        for name, original in self.originals.items():
+            setattr(self.collection_class, name, original)
+
+    def total(self):
+        return sum(self.counts.values())
+
+    def _wrap(self, name, original):
+        counter = self
+
+        @functools.wraps(original)
+        def wrapper(self, *args, **kwargs):
+            depth = getattr(counter.local, 'depth', 0)
+            if depth == 0:
+                with counter.lock:
+                    counter.counts['{}.{}'.format(self.name, name)] += 1
+            counter.local.depth = depth + 1
+            try:
+                return original(self, *args, **kwargs)
+            finally:
+                counter.local.depth = depth
+        return wrapper
+
+
+class LoadTest:
+    def __init__(self, main_module, api, think_time=0.1, wait_timeout=30):
+        self.main = main_module
+        self.api = api
+        self.think_time = think_time
+        self.wait_timeout = wait_timeout
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.webhook_latencies = []
+        self.posted_at = {}
+        self.processing_latencies = []
+        self.branch_latencies = defaultdict(list)
+        self.double_pairings = []
+        self.timeouts = 0
+        main_module.on_transition(self._record_transition)
+
+    def _record_transition(self, ctx, handler, label):
+        finished = time.monotonic()
+        with self.lock:
+            posted = self.posted_at.pop((ctx.user_id, ctx.msg.message_id), None)
+            if posted is not None:
+                self.processing_latencies.append(finished - posted)
+                self.branch_latencies[label].append(finished - posted)
+
+    def post(self, client, user_id, text):
+        message_id = next(self.message_ids)
+        update = {
+            'update_id': next(self.update_ids),
+            'message': {
+                'message_id': message_id, 'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': {'id': user_id, 'is_bot': False, 'first_name': 'Player', 'username': 'player{}'.format(user_id)},
+                'text': text,
+            },
+        }
+        started = time.monotonic()
+        with self.lock:
+            self.posted_at[(user_id, message_id)] = started
+        response = client.post('/' + self.main.TELEBOT_URL + self.main.TOKEN, data=json.dumps(update))
+        with self.lock:
+            self.webhook_latencies.append(time.monotonic() - started)
+        return response.status_code
+
+    def wait_for(self, user_id, cursor, *fragments):
+        """ Wait for a bot message containing one of the fragments; return (new cursor, text or None) """
+        index, message = self.api.wait_for_message(
+            user_id, lambda m: any(f in (m.get('text') or '') for f in fragments), start=cursor,
+            timeout=self.wait_timeout,
+        )
+        if message is None:
+            with self.lock:
+                self.timeouts += 1
+            return cursor, None
+        return index + 1, message['text']
+
+    def play(self, user_id, games, turns):
+        main = self.main
+        client = main.server.test_client()
+        cursor = 0
+        rnd = random.Random(user_id)
+        self.post(client, user_id, '/start')
+        cursor, _ = self.wait_for(user_id, cursor, 'Привет!')
+        if rnd.random() < 0.5:
+            self.post(client, user_id, main.SUGGEST_SUBSCRIBE)
+        for _ in range(games):
+            self.post(client, user_id, main.SUGGEST_START_GAME)
+            cursor, text = self.wait_for(user_id, cursor, 'Игра началась')
+            if text is None:
+                self.post(client, user_id, main.SUGGEST_NOT_START_GAME)
+                continue
+            is_buyer = 'ПОКУПАТЕЛЬ' in text
+            for turn in range(turns):
+                time.sleep(self.think_time * rnd.random())
+                self.post(client, user_id, 'Сообщение {} от игрока {}'.format(turn, user_id))
+            endings = ['Ура', 'Окей, вы завершили', 'решил завершить игру', 'Игра началась']
+            if is_buyer:
+                self.post(client, user_id, main.SUGGEST_DO_BUY if rnd.random() < 0.5 else main.SUGGEST_NOT_BUY)
+            elif rnd.random() < 0.2:
+                self.post(client, user_id, main.SUGGEST_END_GAME)
+            cursor, text = self.wait_for(user_id, cursor, *endings)
+            if text is not None and 'Игра началась' in text:
+                with self.lock:
+                    self.double_pairings.append(user_id)
+            elif text is not None and 'решил завершить игру' not in text:
+                self.post(client, user_id, 'Отзыв игрока {}'.format(user_id))
+                cursor, _ = self.wait_for(user_id, cursor, 'Ага, понятно')
+
+    def check_pairs(self):
+        """ Every user in a game must be the counterparty of their counterparty, in the same game """
+        users = {u['user_id']: u for u in self.main.mongo_users.find({'current_state': self.main.STATE_IN_GAME})}
+        broken = []
+        for user_id, user in users.items():
+            other = self.main.mongo_users.find_one({'user_id': user['counterparty']})
+            if other is None or other.get('counterparty') != user_id or other.get('game_id') != user['game_id']:
+                broken.append(user_id)
+        starts = defaultdict(int)
+        for log in self.main.mongo_game_logs.find({'event': 'game_start'}):
+            starts[log['game_id']] += 1
+        return broken, [game_id for game_id, count in starts.items() if count != 1]
+
+
+def run(args):
+    os.environ.setdefault('TOKEN', '123456:loadtest')
+    if args.mongo:
+        os.environ['MONGODB_URI'] = args.mongo
+    else:
+        os.environ.pop('MONGODB_URI', None)
+    api = FakeTelegramApi(latency=args.latency, error_rate=args.error_rate).start()
+
+    import telebot
+    telebot.apihelper.API_URL = api.api_url
+    import main
+
+    # main wraps its collections, so the class of a raw collection is instrumented
+    counter = MongoOpCounter(type(main.mongo_db.get_collection('users')))
+    counter.install()
+    test = LoadTest(main, api, think_time=args.think_time, wait_timeout=args.wait_timeout)
+    players = [threading.Thread(target=test.play, args=(1000 + i, args.games, args.turns)) for i in range(args.players)]
+    started = time.monotonic()
+    for player in players:
+        player.start()
+    for player in players:
+        player.join()
+    main.update_pool.join()
+    main.outbound.flush(timeout=60)
+    main.log_writer.flush()
+    elapsed = time.monotonic() - started
+    counter.uninstall()
+
+    broken_pairs, repeated_starts = test.check_pairs()
+    updates = len(test.webhook_latencies)
+    results = {
+        'parameters': vars(args),
+        'updates': updates,
+        'elapsed': elapsed,
+        'updates_per_second': updates / elapsed if elapsed else None,
+        'webhook_latency': summarize(test.webhook_latencies),
+        'processing_latency': summarize(test.processing_latencies),
+        'branch_latency': {label: summarize(values) for label, values in test.branch_latencies.items()},
+        'mongo_ops': dict(counter.counts),
+        'mongo_ops_per_update': counter.total() / updates if updates else None,
+        'telegram_calls': dict(api.call_counts),
+        'telegram_429_sent': api.errors_sent,
+        'player_timeouts': test.timeouts,
+        'matchmaking': {
+            'double_pairings': test.double_pairings,
+            'asymmetric_pairs': broken_pairs,
+            'games_with_repeated_start': repeated_starts,
+            'ok': not (test.double_pairings or broken_pairs or repeated_starts),
+        },
+    }
+    api.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the bot with simulated players')
+    parser.add_argument('--players', type=int, default=20)
+    parser.add_argument('--games', type=int, default=2, help='games per player')
+    parser.add_argument('--turns', type=int, default=5, help='messages per player per game')
+    parser.add_argument('--think-time', type=float, default=0.2, help='max pause between messages, seconds')
+    parser.add_argument('--latency', type=float, default=0.02, help='latency of the fake Telegram API, seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of sends answered with 429')
+    parser.add_argument('--wait-timeout', type=float, default=30, help='how long a player waits for the bot')
+    parser.add_argument('--mongo', help='MongoDB URI (by default, mongomock)')
+    parser.add_argument('--output', help='save the results as JSON to this file')
+    args = parser.parse_args()
+
+    results = run(args)
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,47 +1,146 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 import argparse
-import mongomock
+import atexit
+import bulk_writer
+import functools
+import itertools
+import json
+import logging
 import os
 import random
+import signal
 import telebot
+import threading
 import time
 import uuid
 
-from datetime import datetime
-from flask import Flask, request
+from archive import Archive
+from broadcast import Broadcaster
+from datetime import datetime, timedelta
+from dedup import UpdateDeduplicator
+from expiry import ExpiryScheduler
+from export import make_export_blueprint, render_logs_page
+from flask import Flask, Response, request
+from games import GAME_FINISHED, GAME_IN_PROGRESS, GameStore, TransitionConflict
+from indexes import ensure_indexes
+from instrumentation import InstrumentedCollection, Registry, setup_logging
+from matchmaking import Matchmaker
+from outbound import OutboundDispatcher
+from polling import PollingEngine
 from pymongo import MongoClient
+from startup import LazyProxy, StartupTimer
+from transactions import run_in_transaction
+from user_cache import UserCache, make_invalidation_channel
+from workers import ShardedWorkerPool
 
 
+startup = StartupTimer()
+startup.mark('imports')
+setup_logging(os.environ.get('LOG_LEVEL', 'INFO'))
+logger = logging.getLogger(__name__)
+
+metrics = Registry()
+MESSAGES_TOTAL = metrics.counter('bot_messages_total', 'Processed messages, by branch', ['branch'])
+MESSAGE_DURATION = metrics.histogram(
+    'bot_message_duration_seconds', 'Time to process a message, by branch', ['branch']
+)
+MONGO_DURATION = metrics.histogram(
+    'bot_mongo_call_duration_seconds', 'Duration of MongoDB calls', ['collection', 'method']
+)
+TELEGRAM_DURATION = metrics.histogram(
+    'bot_telegram_call_duration_seconds', 'Duration of Telegram Bot API calls', ['method']
+)
+
+
+def timed_telegram_request(method, url, **kwargs):
+    with TELEGRAM_DURATION.time(method=url.rsplit('/', 1)[-1]):
+        return telebot.apihelper._get_req_session().request(method, url, **kwargs)
+
+
+telebot.apihelper.CUSTOM_REQUEST_SENDER = timed_telegram_request
+
 TOKEN = os.environ['TOKEN']
-bot = telebot.TeleBot(TOKEN)
+# updates are processed by our own sharded pool, which keeps the order of messages of each user
+bot = telebot.TeleBot(TOKEN, threaded=False)
 
 server = Flask(__name__)
 TELEBOT_URL = 'telegram/'
 BASE_URL = 'https://wizard-of-music.herokuapp.com/'
 
 MONGO_URL = os.environ.get('MONGODB_URI')
-if MONGO_URL is not None:
-    mongo_client = MongoClient(MONGO_URL)
-    mongo_db = mongo_client.get_default_database()
-else:
-    mongo_client = mongomock.MongoClient()
-    mongo_db = mongo_client.db
+
+
+def connect_mongo():
+    if MONGO_URL is not None:
+        # resolving a mongodb+srv:// URL takes DNS round trips, and connect=False defers the rest to the first query
+        return MongoClient(MONGO_URL, connect=False)
+    import mongomock
+    return mongomock.MongoClient()
+
+
+# the client, the database and the collections are created on the first use, not when main is imported
+mongo_client = LazyProxy(connect_mongo)
+mongo_db = LazyProxy(lambda: mongo_client.get_default_database() if MONGO_URL is not None else mongo_client.db)
+
+
+def lazy_collection(name):
+    return InstrumentedCollection(LazyProxy(lambda: mongo_db.get_collection(name)), MONGO_DURATION)
+
 
 # user_id, username, allow_notifications, current_role, current_state, counterparty, game_id
-mongo_users = mongo_db.get_collection('users')
+mongo_users = lazy_collection('users')
 # event, sender, receiver, text, sender_role, game_id, timestamp, message_id
-mongo_game_logs = mongo_db.get_collection('game_logs')
+mongo_game_logs = lazy_collection('game_logs')
 # user_id, from_user, text, timestamp, message_id
-mongo_messages = mongo_db.get_collection('messages')
-
-PROCESSED_MESSAGES = set()
+mongo_messages = lazy_collection('messages')
+# user_id, enqueued_at, last_activity
+mongo_waiting = lazy_collection('waiting_players')
+# _id (game_id), players, state, outcome, ended_by, version, created_at, updated_at, last_activity
+mongo_games = lazy_collection('games')
+# _id ("chat_id:message_id"), created_at
+mongo_processed_updates = lazy_collection('processed_updates')
+# user_id, origin, created_at
+mongo_cache_invalidations = lazy_collection('user_cache_invalidations')
+
+user_cache = UserCache(mongo_users, channel=make_invalidation_channel(mongo_cache_invalidations))
+
+# analytics logs (messages and game_logs) are written in background batches, unless LOG_WRITE_MODE=sync
+log_writer = bulk_writer.BufferedWriter(mode=os.environ.get('LOG_WRITE_MODE', bulk_writer.MODE_ASYNC))
+atexit.register(log_writer.stop)
+
+# the shared tier is needed only when several workers may receive the same update
+deduplicator = UpdateDeduplicator(
+    collection=mongo_processed_updates if MONGO_URL is not None else None
+)
+
+outbound = OutboundDispatcher()
+# registered after the log writer, so that it is stopped first and its last messages are still logged
+atexit.register(outbound.stop, timeout=10)
+
+
+WEBHOOK_URL = BASE_URL + TELEBOT_URL + TOKEN
+# how many webhook requests Telegram may send at once; 40 is its default
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get('WEBHOOK_MAX_CONNECTIONS', 40))
+
+
+def ensure_webhook():
+    """
+    Register the webhook, unless it is registered already: a woken up dyno makes one request instead of two.
+    The URL and max_connections are managed; the other webhook settings are left as Telegram's defaults.
+    setWebhook replaces the previous webhook, so there is no moment without a webhook, when updates would be lost.
+    """
+    info = bot.get_webhook_info()
+    if info.url == WEBHOOK_URL and info.max_connections in (None, WEBHOOK_MAX_CONNECTIONS):
+        return False
+    bot.set_webhook(url=WEBHOOK_URL, max_connections=WEBHOOK_MAX_CONNECTIONS)
+    logger.info('registered the webhook')
+    return True
 
 
 @server.route("/" + TELEBOT_URL)
 def web_hook():
-    bot.remove_webhook()
-    bot.set_webhook(url=BASE_URL + TELEBOT_URL + TOKEN)
+    ensure_webhook()
     return "!", 200
 
 
@@ -51,33 +150,126 @@ def wake_up():
     return "Маам, ну ещё пять минуточек!", 200
 
 
+def get_update_key(update):
+    for item in (update.message, update.edited_message, update.callback_query):
+        if item is not None and item.from_user is not None:
+            return item.from_user.id
+    return update.update_id
+
+
+def process_update(update):
+    bot.process_new_updates([update])
+
+
+update_pool = ShardedWorkerPool(
+    process_update,
+    num_shards=int(os.environ.get('WORKER_SHARDS', 0)) or None,
+    max_queue_size=int(os.environ.get('WORKER_QUEUE_SIZE', 1000)),
+    backpressure=os.environ.get('WORKER_BACKPRESSURE', 'block'),
+    name='updates',
+)
+atexit.register(update_pool.stop)
+
+
 @server.route('/' + TELEBOT_URL + TOKEN, methods=['POST'])
 def get_message():
-    bot.process_new_updates([telebot.types.Update.de_json(request.stream.read().decode("utf-8"))])
+    update = telebot.types.Update.de_json(request.stream.read().decode("utf-8"))
+    if not update_pool.submit(get_update_key(update), update):
+        # Telegram will retry the update later
+        return "overloaded", 503
     return "!", 200
 
 
+@server.route("/status/")
+def get_status():
+    status = {
+        'update_queue_depth': update_pool.queue_depth(),
+        'update_shard_depths': update_pool.shard_depths(),
+        'updates_rejected': update_pool.rejected,
+        'outbound_queue_depth': outbound.queue_depth(),
+        'log_writer_pending': log_writer.pending(),
+        'startup_seconds': startup.as_dict(),
+    }
+    return Response(json.dumps(status), mimetype='application/json')
+
+
+def count_users_by_state():
+    # each count is served by the current_state index
+    states = [STATE_ACTIVE, STATE_INACTIVE, STATE_IN_GAME, STATE_FEEDBACK_TERMS, STATE_FEEDBACK_WHY_NOT]
+    return {(state,): mongo_users.count_documents({'current_state': state}) for state in states}
+
+
+metrics.gauge('bot_users', 'Users, by state', count_users_by_state, ['state'])
+metrics.gauge('bot_waiting_players', 'Players in the matchmaking queue', lambda: mongo_waiting.count_documents({}))
+metrics.gauge('bot_update_queue_depth', 'Updates waiting to be processed', lambda: update_pool.queue_depth())
+metrics.gauge('bot_outbound_queue_depth', 'Messages waiting to be sent', lambda: outbound.queue_depth())
+metrics.gauge('bot_log_writer_pending', 'Log documents waiting to be written', lambda: log_writer.pending())
+metrics.callback_counter(
+    'bot_user_cache_lookups_total', 'User cache lookups, by result',
+    lambda: {('hit',): user_cache.hits, ('miss',): user_cache.misses}, ['result'],
+)
+
+metrics.callback_counter(
+    'bot_waiting_notifications_total', '"Someone is ready" notifications, by result',
+    lambda: {('sent',): waiting_broadcaster.sent, ('suppressed',): waiting_broadcaster.suppressed}, ['result'],
+)
+metrics.gauge(
+    'bot_expiry_pending', 'Waiting players and games in progress tracked for expiry, by scheduler',
+    lambda: {(scheduler.name,): scheduler.pending() for scheduler in (waiting_expiry, game_expiry)}, ['scheduler'],
+)
+metrics.callback_counter(
+    'bot_expiry_deadlines_total', 'Waiting players and games that have reached their expiry deadline, by scheduler',
+    lambda: {(scheduler.name,): scheduler.expired for scheduler in (waiting_expiry, game_expiry)}, ['scheduler'],
+)
+
+
+@server.route("/metrics")
+def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+# on prod, the logs can be seen only by the users listed in ADMIN_IDS
+ADMIN_IDS = {int(user_id) for user_id in os.environ.get('ADMIN_IDS', '').split(',') if user_id.strip()}
+
+server.register_blueprint(make_export_blueprint(
+    {'game_logs': mongo_game_logs, 'messages': mongo_messages}, token=os.environ.get('EXPORT_TOKEN'),
+    archive=LazyProxy(lambda: Archive(mongo_db)),
+))
+
+
 @bot.message_handler(commands=['logs'])
 def get_game_logs(m):
-    if MONGO_URL is None:
-        result = '\n'.join([str(row) for row in mongo_game_logs.find({})])
-        bot.send_message(m.chat.id, result or 'logs are empty so far')
-    else:
-        bot.send_message(m.shat.id, "На проде логи нельзя посмотреть из бота.")
+    if MONGO_URL is not None and m.from_user.id not in ADMIN_IDS:
+        bot.send_message(m.chat.id, "На проде логи нельзя посмотреть из бота.")
+        return
+    # /logs [cursor]
+    parts = m.text.split()
+    result, next_cursor = render_logs_page(mongo_game_logs, cursor=parts[1] if len(parts) > 1 else None)
+    if next_cursor is not None:
+        result += '\n\nnext page: /logs {}'.format(next_cursor)
+    bot.send_message(m.chat.id, result or 'logs are empty so far')
 
 
-def render_markup(suggests=None, max_columns=3, initial_ratio=2):
-    if suggests is None or len(suggests) == 0:
-        return telebot.types.ReplyKeyboardRemove(selective=False)
+class SerializedMarkup(telebot.types.JsonSerializable):
+    # a keyboard that has been serialized once and is sent as a ready JSON string
+    def __init__(self, markup):
+        self.json = markup.to_json()
+
+    def to_json(self):
+        return self.json
+
+
+@functools.lru_cache(maxsize=1024)
+def _render_serialized_markup(suggests, max_columns, initial_ratio):
+    if len(suggests) == 0:
+        return SerializedMarkup(telebot.types.ReplyKeyboardRemove(selective=False))
     markup = telebot.types.ReplyKeyboardMarkup(row_width=max(1, min(max_columns, int(len(suggests) / initial_ratio))))
     markup.add(*suggests)
-    return markup
+    return SerializedMarkup(markup)
 
 
-def text_is_like(text, pattern):
-    def preprocess(s):
-        return s.lower().strip()
-    return preprocess(text) in {preprocess(p) for p in pattern}
+def render_markup(suggests=None, max_columns=3, initial_ratio=2):
+    return _render_serialized_markup(tuple(suggests or ()), max_columns, initial_ratio)
 
 
 SUGGEST_SUBSCRIBE = 'Получать уведомления'
@@ -165,7 +357,29 @@ ROLES_INTRO_DICT = {ROLE_BUYER: INTRO_BUYER, ROLE_SELLER: INTRO_SELLER}
 
 ROLES_INITIAL_SUGGESTS_DICT = {ROLE_BUYER: INITIAL_BUYER_SUGGESTS, ROLE_SELLER: INITIAL_SELLER_SUGGESTS}
 
-ALL_CONTENT_TYPES = ['document', 'text', 'photo', 'audio', 'video',  'location', 'contact', 'sticker']
+# the initial suggests are shown in a random order; all the orders are rendered in advance
+ROLES_INITIAL_MARKUPS_DICT = {
+    role: [render_markup(list(permutation)) for permutation in itertools.permutations(suggests)]
+    for role, suggests in ROLES_INITIAL_SUGGESTS_DICT.items()
+}
+
+ALL_CONTENT_TYPES = [
+    'document', 'text', 'photo', 'audio', 'video',  'location', 'contact', 'sticker', 'voice', 'video_note',
+    'animation',
+]
+
+
+def choose_roles(user_id, counterparty):
+    if random.random() < 0.5:
+        return ROLE_SELLER, ROLE_BUYER
+    return ROLE_BUYER, ROLE_SELLER
+
+
+games = GameStore(mongo_games)
+matchmaker = Matchmaker(
+    mongo_client, mongo_users, mongo_waiting, waiting_state=STATE_ACTIVE, game_state=STATE_IN_GAME, games=games
+)
+
 
 INACTIVE_UPDATE = {
     '$set': {'current_state': STATE_INACTIVE, 'counterparty': None, 'game_id': None, 'current_role': None}
@@ -173,7 +387,7 @@ INACTIVE_UPDATE = {
 
 
 def get_reply_markup_for_id(user_id):
-    user_object = mongo_users.find_one({'user_id': user_id})
+    user_object = user_cache.get(user_id)
     return render_markup_for_user_object(user_object)
 
 
@@ -194,48 +408,574 @@ def get_suggests_for_user_object(user_object):
     return [subscription_suggest] + game_suggests
 
 
-def shuffled(some_list):
-    items = some_list[:]
-    random.shuffle(items)
-    return items
-
-
 def render_markup_for_user_object(user_object):
     if user_object is None:
         return render_markup([])
     return render_markup(get_suggests_for_user_object(user_object))
 
 
+# only the fields needed to render the keyboard of a user
+SUGGESTS_PROJECTION = {'_id': 0, 'user_id': 1, 'allow_notifications': 1, 'current_state': 1, 'current_role': 1}
+
+
 def find_subscribed_users():
-    user_ids = []
-    user_objects = list(mongo_users.find({'allow_notifications': True, 'current_state': STATE_ACTIVE})) \
-        + list(mongo_users.find({'allow_notifications': True, 'current_state': STATE_INACTIVE}))
-    for uo in user_objects:
-        user_ids.append(uo['user_id'])
-    random.shuffle(user_ids)
-    return user_ids
+    user_objects = list(mongo_users.find(
+        {'allow_notifications': True, 'current_state': {'$in': [STATE_ACTIVE, STATE_INACTIVE]}},
+        SUGGESTS_PROJECTION,
+    ))
+    random.shuffle(user_objects)
+    return user_objects
 
 
-def send_text_to_user(user_id, text, reply_markup=None):
+def send_text_to_user(user_id, text, reply_markup=None, background=False):
     if reply_markup is None:
         reply_markup = get_reply_markup_for_id(user_id)
-    result = bot.send_message(user_id, text, reply_markup=reply_markup, parse_mode='html')
-    mongo_messages.insert_one({
-        'user_id': user_id,
-        'from_user': False,
-        'text': text,
-        'timestamp': datetime.utcnow(),
-        'message_id': result.message_id
+
+    def log_sent_message(result):
+        log_writer.insert(mongo_messages, {
+            'user_id': user_id,
+            'from_user': False,
+            'text': text,
+            'timestamp': datetime.utcnow(),
+            'message_id': result.message_id
+        })
+    outbound.enqueue(
+        user_id, bot.send_message, user_id, text, reply_markup=reply_markup, parse_mode='html',
+        on_success=log_sent_message, background=background,
+    )
+
+
+ANY = '*'
+COMMAND_NO_TEXT = '<no text>'
+COMMANDS = frozenset([
+    SUGGEST_SUBSCRIBE, SUGGEST_UNSUBSCRIBE, SUGGEST_START_GAME, SUGGEST_NOT_START_GAME, SUGGEST_END_GAME,
+    SUGGEST_DO_BUY, SUGGEST_NOT_BUY, '/help',
+])
+
+# (state, role, command) -> handler; state, role and command may be ANY
+TRANSITIONS = {}
+# how many times a message is re-dispatched when its transition conflicts with a concurrent one
+MAX_TRANSITION_ATTEMPTS = 3
+# functions called as hook(ctx, handler, label) after every handled message
+TRANSITION_HOOKS = []
+
+
+def normalize_command(text):
+    if not text:
+        return COMMAND_NO_TEXT
+    return text if text in COMMANDS else ANY
+
+
+def transition(states=(ANY,), roles=(ANY,), commands=(ANY,)):
+    """ Register the decorated function as the handler of all the combinations of states, roles and commands """
+    def register(handler):
+        for key in itertools.product(states, roles, commands):
+            TRANSITIONS[key] = handler
+        return handler
+    return register
+
+
+def on_transition(hook):
+    TRANSITION_HOOKS.append(hook)
+    return hook
+
+
+def find_transition(state, role, command):
+    # a command specific to the state beats a command available everywhere, which beats free text in the state
+    for key in (
+            (state, role, command), (state, ANY, command), (ANY, ANY, command),
+            (state, role, ANY), (state, ANY, ANY), (ANY, ANY, ANY),
+    ):
+        handler = TRANSITIONS.get(key)
+        if handler is not None:
+            return handler
+
+
+class MessageContext:
+    def __init__(self, msg, user_object, started_at, inbound_log=None):
+        self.msg = msg
+        self.started_at = started_at
+        # the log record of the incoming message, if the handler is to write it (otherwise, it is already written)
+        self.inbound_log = inbound_log
+        self.text = msg.text
+        self.user_id = msg.from_user.id
+        self.user_object = user_object
+        self.current_state = user_object.get('current_state')
+        self.current_role = user_object.get('current_role')
+        self.current_role_name = ROLES_DICT.get(self.current_role, 'undefined')
+        self.counterparty = user_object.get('counterparty')
+        self.game_id = user_object.get('game_id')
+        self.suggested_suggests = get_suggests_for_user_object(user_object)
+        self.subscription_suggest = self.suggested_suggests[0]
+        self.game_suggests = self.suggested_suggests[1:]
+
+    @property
+    def default_markup(self):
+        return render_markup(self.suggested_suggests)
+
+    def add_game_log(self, log_event, log_text, log_sender_role=None):
+        log_writer.insert(mongo_game_logs, self.make_game_log(log_event, log_text, log_sender_role))
+
+    def make_game_log(self, log_event, log_text, log_sender_role=None):
+        if log_sender_role is None:
+            log_sender_role = self.current_role
+        logger.debug('add game log: event "%s", text "%s", role "%s"', log_event, log_text, log_sender_role)
+        return {
+            'event': log_event,
+            'sender': self.user_id,
+            'receiver': self.counterparty,
+            'text': log_text,
+            'sender_role': log_sender_role,
+            'game_id': self.game_id,
+            'timestamp': datetime.now(),
+            'message_id': self.msg.message_id
+        }
+
+
+@on_transition
+def record_transition(ctx, handler, label):
+    MESSAGES_TOTAL.inc(branch=label)
+    MESSAGE_DURATION.observe(time.perf_counter() - ctx.started_at, branch=label)
+    logger.debug("class: %s", label)
+
+
+@transition(commands=[COMMAND_NO_TEXT])
+def handle_no_text(ctx):
+    send_text_to_user(
+        ctx.user_id,
+        '<i>Я пока не поддерживаю стикеры, фото и т.п.\nПожалуйста, пользуйтесь текстом и смайликами \U0001F642</i>',
+        reply_markup=ctx.default_markup)
+    return "no text detected"
+
+
+@transition(commands=[SUGGEST_SUBSCRIBE])
+def handle_subscribe(ctx):
+    if ctx.user_object.get('allow_notifications'):
+        send_text_to_user(
+            ctx.user_id, '<i>Вы уже и так подписаны на обновления о новых игроках!</i>',
+            reply_markup=ctx.default_markup,
+        )
+        return "subscribe, but already subscribed"
+    user_cache.update(ctx.user_id, {'$set': {'allow_notifications': True}})
+    send_text_to_user(
+        ctx.user_id, '<i>Теперь вы подписаны на обновления о новых игроках!</i>',
+        reply_markup=render_markup([SUGGEST_UNSUBSCRIBE] + ctx.game_suggests)
+    )
+    return "subscribe successfully"
+
+
+@transition(commands=[SUGGEST_UNSUBSCRIBE])
+def handle_unsubscribe(ctx):
+    if not ctx.user_object.get('allow_notifications'):
+        send_text_to_user(
+            ctx.user_id, '<i>Вы уже и так отписаны от обновлений о новых игроках!</i>',
+            reply_markup=ctx.default_markup
+        )
+        return "unsubscribe, but already unsubscribed"
+    user_cache.update(ctx.user_id, {'$set': {'allow_notifications': False}})
+    send_text_to_user(
+        ctx.user_id, '<i>Теперь вы отписаны от обновлений о новых игроках.</i>',
+        reply_markup=render_markup([SUGGEST_SUBSCRIBE] + ctx.game_suggests)
+    )
+    return "unsubscribe successfully"
+
+
+@transition(states=STATES_OUTSIDE, commands=[SUGGEST_START_GAME])
+def handle_start_game(ctx):
+    user_id = ctx.user_id
+    game_id = str(uuid.uuid4())
+    match = matchmaker.find_partner(user_id, game_id, choose_roles)
+    if match is None:
+        if ctx.current_state != STATE_ACTIVE:
+            result = user_cache.update(
+                user_id, {'$set': {'current_state': STATE_ACTIVE}}, extra_filter={'current_state': ctx.current_state}
+            )
+            if not result.matched_count:
+                raise TransitionConflict('user {} is no longer {}'.format(user_id, ctx.current_state))
+        matchmaker.join(user_id)
+        # sent before looking again, so that it cannot come after the start of a game with a player who claims this one
+        send_text_to_user(
+            user_id,
+            '<i>Сейчас нет свободных игроков. Игра начнётся, как только другой игрок будет готов.'
+            '\nЕсли вы не хотите начинать игру, как только другой игрок появится, нажмите "{}"</i>'.format(
+                SUGGEST_NOT_START_GAME
+            ),
+            reply_markup=render_markup([ctx.subscription_suggest, SUGGEST_NOT_START_GAME]),
+        )
+        # another player may have found nobody at the same time, and joined the queue just before this one
+        match = matchmaker.find_partner(user_id, game_id, choose_roles, joined=True)
+    if match is not None:
+        counterparty, new_role, new_counterparty_role = match
+        user_cache.apply(user_id, {'$set': {
+            'current_state': STATE_IN_GAME, 'current_role': new_role, 'counterparty': counterparty, 'game_id': game_id,
+        }})
+        user_cache.apply(counterparty, {'$set': {
+            'current_state': STATE_IN_GAME, 'current_role': new_counterparty_role, 'counterparty': user_id,
+            'game_id': game_id,
+        }})
+        ctx.counterparty = counterparty
+        ctx.game_id = game_id
+        waiting_expiry.cancel(user_id)
+        waiting_expiry.cancel(counterparty)
+        game_expiry.touch(game_id, persist=False)
+        ctx.add_game_log(log_event='game_start', log_text=None, log_sender_role=new_role)
+        send_text_to_user(
+            user_id, INTRO_START_PREFIX + ROLES_INTRO_DICT[new_role],
+            reply_markup=random.choice(ROLES_INITIAL_MARKUPS_DICT[new_role])
+        )
+        send_text_to_user(
+            counterparty,
+            INTRO_START_PREFIX + ROLES_INTRO_DICT[new_counterparty_role],
+            reply_markup=random.choice(ROLES_INITIAL_MARKUPS_DICT[new_counterparty_role])
+        )
+        return "start new game successfully"
+
+    if not matchmaker.is_waiting(user_id):
+        # another player has just claimed this one, and tells both of them that the game has started
+        return "tried to start new game, and was claimed by another player"
+    waiting_expiry.touch(user_id, persist=False)
+    waiting_broadcaster.trigger(exclude_user_id=user_id)
+    return "tried to start new game, but has no counterparty"
+
+
+@transition(states=[STATE_IN_GAME], commands=[SUGGEST_START_GAME])
+def handle_start_game_in_game(ctx):
+    send_text_to_user(
+        ctx.user_id, '<i>Вы и так уже в игре! Ваша роль - {}</i>'.format(ctx.current_role_name),
+        reply_markup=ctx.default_markup
+    )
+    return "tried to start new game, but already in a game"
+
+
+@transition(states=STATES_OUTSIDE, commands=[SUGGEST_END_GAME])
+def handle_end_game_outside(ctx):
+    send_text_to_user(
+        ctx.user_id,
+        '<i>Вы уже и так не играете. Нажмите "{}", чтобы не получать приглашения в следующие игры</i>'.format(
+            SUGGEST_UNSUBSCRIBE
+        ),
+        reply_markup=ctx.default_markup
+    )
+    return "tried to end a game, but already not in a game"
+
+
+def finish_game(ctx, outcome, user_update, counterparty_update):
+    """
+    Finish the game of the sender and update both players at once.
+    Raise TransitionConflict if the game has already been finished by a concurrent request.
+    """
+    # the cached users are changed only after the commit, as the transaction may be aborted or retried
+    counterparty_matched = []
+
+    def apply(session):
+        games.transition(
+            ctx.game_id, GAME_IN_PROGRESS,
+            {'state': GAME_FINISHED, 'outcome': outcome, 'ended_by': ctx.user_id},
+            session=session,
+        )
+        user_filter = {'user_id': ctx.user_id, 'game_id': ctx.game_id, 'current_state': STATE_IN_GAME}
+        if not mongo_users.update_one(user_filter, user_update, session=session).matched_count:
+            raise TransitionConflict('user {} is no longer in game {}'.format(ctx.user_id, ctx.game_id))
+        counterparty_filter = {'user_id': ctx.counterparty, 'game_id': ctx.game_id}
+        counterparty_matched[:] = [
+            mongo_users.update_one(counterparty_filter, counterparty_update, session=session).matched_count
+        ]
+    run_in_transaction(mongo_client, apply)
+    user_cache.apply(ctx.user_id, user_update)
+    if counterparty_matched[0]:
+        user_cache.apply(ctx.counterparty, counterparty_update)
+    else:
+        user_cache.forget(ctx.counterparty)
+    game_expiry.cancel(ctx.game_id)
+
+
+@transition(states=[STATE_IN_GAME], roles=[ROLE_SELLER], commands=[SUGGEST_END_GAME])
+def handle_end_game_by_seller(ctx):
+    finish_game(ctx, 'no_deal_by_seller', {'$set': {'current_state': STATE_FEEDBACK_WHY_NOT}}, INACTIVE_UPDATE)
+    ctx.add_game_log(log_event='game_end_by_seller', log_text=None)
+
+    send_text_to_user(
+        ctx.user_id,
+        '<i>Окей, вы завершили игру без сделки. Спасибо вам за эту игру!'
+        '\nПожалуйста, кратко расскажите в следующем сообщении, почему вы решили завершить игру?</i>',
+        reply_markup=[]
+    )
+
+    send_text_to_user(
+        ctx.counterparty,
+        '<i>Продавец решил завершить игру без сделки. '
+        '\nБольшое спасибо вам за игру! Приходите ещё \U0001F60A</i>'
+    )
+    return "game ended by seller unsuccessfully; ask seller why"
+
+
+@transition(states=[STATE_IN_GAME], roles=[ROLE_BUYER], commands=[SUGGEST_DO_BUY])
+def handle_do_buy(ctx):
+    feedback_update = {'$set': {'current_state': STATE_FEEDBACK_TERMS}}
+    finish_game(ctx, 'deal', feedback_update, feedback_update)
+    ctx.add_game_log(log_event='game_end_by_buyer_did_buy', log_text=None)
+
+    send_text_to_user(
+        ctx.user_id,
+        '<i>Ура, вы согласились купить подписку!'
+        '\nПожалуйста, кратко опишите условия сделки '
+        '(на какой цене вы сошлись; какие особые условия, если они есть).'
+        '\nВажно: надо уложиться в одно сообщение.</i>',
+        reply_markup=render_markup([])
+    )
+
+    send_text_to_user(
+        ctx.counterparty,
+        '<i>Ура, ваш клиент согласился купить подписку!'
+        '\nПожалуйста, кратко опишите условия сделки '
+        '(на какой цене вы сошлись; какие особые условия, если они есть).'
+        '\nВажно: надо уложиться в одно сообщение.</i>',
+        reply_markup=render_markup([])
+    )
+    return "game ended by buyer successfully; ask buyer and seller about terms"
+
+
+@transition(states=[STATE_IN_GAME], roles=[ROLE_BUYER], commands=[SUGGEST_NOT_BUY])
+def handle_not_buy(ctx):
+    finish_game(ctx, 'no_deal_by_buyer', {'$set': {'current_state': STATE_FEEDBACK_WHY_NOT}}, INACTIVE_UPDATE)
+    ctx.add_game_log(log_event='game_end_by_buyer_did_not_buy', log_text=None)
+
+    send_text_to_user(
+        ctx.user_id,
+        '<i>Окей, вы завершили игру без сделки. Спасибо вам за эту игру!'
+        '\nПожалуйста, кратко расскажите в следующем сообщении, почему вы решили завершить игру?</i>',
+        reply_markup=[]
+    )
+
+    send_text_to_user(
+        ctx.counterparty,
+        '<i>Покупатель решил завершить игру без сделки. '
+        '\nБольшое спасибо вам за игру и обратную связь! Приходите ещё \U0001F60A</i>'
+    )
+    return "game ended by buyer unsuccessfully; ask buyer why"
+
+
+@transition(states=STATES_FEEDBACK)
+def handle_feedback(ctx):
+    if ctx.current_state == STATE_FEEDBACK_TERMS:
+        ctx.add_game_log(log_event='feedback_terms', log_text=ctx.text)
+    elif ctx.current_state == STATE_FEEDBACK_WHY_NOT:
+        ctx.add_game_log(log_event='feedback_why_not', log_text=ctx.text)
+    user_cache.update(ctx.user_id, INACTIVE_UPDATE)
+    send_text_to_user(
+        ctx.user_id,
+        '<i>Ага, понятно.\nБольшое спасибо вам за игру и обратную связь! Приходите ещё \U0001F60A</i>',
+        reply_markup=render_markup([ctx.subscription_suggest, SUGGEST_START_GAME])
+    )
+    return 'terms feedback succesfully collected; game finally ended'
+
+
+@transition(states=[STATE_IN_GAME], commands=[SUGGEST_NOT_START_GAME])
+def handle_not_start_game_in_game(ctx):
+    send_text_to_user(
+        ctx.user_id,
+        '<i>Поздно! Вы уже в игре, ваша роль - {}.'
+        '\nПопробуйте пройти её до конца, а когда завершите, нажмите "{}"</i>'.format(
+            ctx.current_role_name,
+            SUGGEST_END_GAME
+        ),
+        reply_markup=ctx.default_markup
+    )
+    return "tried not to start game, but already in a game"
+
+
+@transition(states=[STATE_INACTIVE], commands=[SUGGEST_NOT_START_GAME])
+def handle_not_start_game_inactive(ctx):
+    send_text_to_user(
+        ctx.user_id,
+        '<i>Вы и так не начинаете игру. '
+        '\nПока вы сами не нажмёте "{}", игра не начнётся.'
+        '\nЕсли вы не хотите получать уведомления о новых игроках, готовых к игре, нажмите "{}"</i>'.format(
+            SUGGEST_START_GAME,
+            SUGGEST_UNSUBSCRIBE
+        ),
+        reply_markup=ctx.default_markup
+    )
+    return "tried not to start a game, but already inactive"
+
+
+@transition(states=[STATE_ACTIVE], commands=[SUGGEST_NOT_START_GAME])
+def handle_not_start_game(ctx):
+    result = user_cache.update(
+        ctx.user_id, {'$set': {'current_state': STATE_INACTIVE}}, extra_filter={'current_state': STATE_ACTIVE}
+    )
+    if not result.matched_count:
+        # e.g. the user has just been paired by another player
+        raise TransitionConflict('user {} is no longer waiting for a game'.format(ctx.user_id))
+    matchmaker.leave(ctx.user_id)
+    waiting_expiry.cancel(ctx.user_id)
+    send_text_to_user(
+        ctx.user_id,
+        '<i>Хорошо, не будем начинать игру '
+        '\nНажмите, "{}", когда снова будете готовы начать игру.'
+        '\nЕсли вы не хотите получать уведомления о новых игроках, готовых к игре, нажмите "{}"</i>'.format(
+            SUGGEST_START_GAME,
+            SUGGEST_UNSUBSCRIBE
+        ),
+        reply_markup=render_markup([ctx.subscription_suggest, SUGGEST_START_GAME])
+    )
+    return "successfully decided not to start a game"
+
+
+# in the feedback states, /help is taken as the feedback itself
+@transition(states=STATES_OUTSIDE | STATES_GAME, commands=['/help'])
+def handle_help(ctx):
+    if ctx.current_role == ROLE_BUYER:
+        send_text_to_user(ctx.user_id, INTRO_BUYER)
+        return 'help to buyer'
+    elif ctx.current_role == ROLE_SELLER:
+        send_text_to_user(ctx.user_id, INTRO_SELLER)
+        return 'help to seller'
+    send_text_to_user(ctx.user_id, WELCOME_TEXT)
+    return 'help outside game'
+
+
+@transition(states=[STATE_IN_GAME], commands=[ANY, COMMAND_NO_TEXT])
+def relay_in_game(ctx):
+    """
+    Copy the message to the counterparty, without downloading and uploading its content, if it is not a text.
+    The sender and the counterparty are resolved from the user cache, and all the logs are written in one batch.
+    """
+    game_expiry.touch(ctx.game_id)
+    msg = ctx.msg
+    if ctx.text:
+        game_log = ctx.make_game_log(log_text=ctx.text, log_event='text')
+    else:
+        game_log = ctx.make_game_log(log_text=None, log_event='media')
+        game_log['content_type'] = msg.content_type
+    logs = [(mongo_game_logs, game_log)]
+    if ctx.inbound_log is not None:
+        logs.append((mongo_messages, ctx.inbound_log))
+    counterparty = ctx.counterparty
+
+    def log_relayed_message(result):
+        log_writer.insert_many(logs + [(mongo_messages, {
+            'user_id': counterparty,
+            'from_user': False,
+            'text': ctx.text,
+            'timestamp': datetime.utcnow(),
+            'message_id': result.message_id
+        })])
+    outbound.enqueue(
+        counterparty, bot.copy_message, counterparty, msg.chat.id, msg.message_id,
+        reply_markup=get_reply_markup_for_id(counterparty),
+        on_success=log_relayed_message, on_failure=lambda exc: log_writer.insert_many(logs),
+    )
+    if ctx.text:
+        return "some random text within a game; sent to the counterparty"
+    return "some media within a game; copied to the counterparty"
+
+
+@transition()
+def handle_random_text(ctx):
+    # todo: болталка, вопросы, и всё такое
+    send_text_to_user(ctx.user_id, WELCOME_TEXT, reply_markup=ctx.default_markup)
+    return "some random text outside a game"
+
+
+def notify_about_waiting_player(user_object):
+    send_text_to_user(
+        user_object['user_id'], '<i>Кто-то готов к новой игре! Вы можете присоединиться!</i>',
+        reply_markup=render_markup_for_user_object(user_object), background=True,
+    )
+
+
+# a subscriber gets at most one "someone is ready" notification per window
+waiting_broadcaster = Broadcaster(
+    find_subscribed_users, notify_about_waiting_player, window=int(os.environ.get('NOTIFICATION_WINDOW', 600))
+)
+
+
+def expire_waiting_player(user_id):
+    cutoff = datetime.utcnow() - timedelta(seconds=waiting_expiry.timeout)
+    # the queue entry may have been claimed or refreshed in the meantime, possibly by another process
+    if not matchmaker.expire(user_id, cutoff):
+        return
+    result = user_cache.update(
+        user_id, {'$set': {'current_state': STATE_INACTIVE}}, extra_filter={'current_state': STATE_ACTIVE}
+    )
+    if result.matched_count:
+        logger.info('user %s has waited for a game for too long', user_id)
+        send_text_to_user(
+            user_id,
+            '<i>Никто так и не пришёл, поэтому я перестал искать вам соперника. '
+            '\nНажмите "{}", когда снова будете готовы начать игру.</i>'.format(SUGGEST_START_GAME)
+        )
+
+
+def expire_game(game_id):
+    game = games.get(game_id)
+    if game is None:
+        # a game started before the games collection existed: its players are unknown
+        return
+    last_activity = game.get('last_activity') or game['created_at']
+    if last_activity > datetime.utcnow() - timedelta(seconds=game_expiry.timeout):
+        # there has been activity in another process
+        game_expiry.touch(game_id, last_activity=last_activity, persist=False)
+        return
+    players = list(game['players'].values())
+
+    # as in finish_game, the cached users are changed only after the commit
+    finished_players = []
+
+    def apply(session):
+        games.transition(game_id, GAME_IN_PROGRESS, {'state': GAME_FINISHED, 'outcome': 'timeout'}, session=session)
+        finished_players[:] = [
+            player for player in players
+            if mongo_users.update_one(
+                {'user_id': player, 'game_id': game_id, 'current_state': STATE_IN_GAME}, INACTIVE_UPDATE,
+                session=session,
+            ).matched_count
+        ]
+    try:
+        run_in_transaction(mongo_client, apply)
+    except TransitionConflict:
+        # the game has been finished by the players themselves
+        return
+    for player in players:
+        if player in finished_players:
+            user_cache.apply(player, INACTIVE_UPDATE)
+        else:
+            user_cache.forget(player)
+    logger.info('game %s has timed out', game_id)
+    log_writer.insert(mongo_game_logs, {
+        'event': 'game_timeout',
+        'sender': None,
+        'receiver': None,
+        'text': None,
+        'sender_role': None,
+        'game_id': game_id,
+        'timestamp': datetime.now(),
+        'message_id': None
     })
-    time.sleep(0.3)
+    for player in players:
+        send_text_to_user(
+            player,
+            '<i>В игре давно ничего не происходило, поэтому я её завершил. '
+            '\nНажмите "{}", чтобы сыграть ещё раз.</i>'.format(SUGGEST_START_GAME)
+        )
+
+
+# players waiting for a game, and games in progress, expire after this many seconds without activity
+waiting_expiry = ExpiryScheduler(
+    int(os.environ.get('WAITING_TIMEOUT', 30 * 60)), expire_waiting_player, name='waiting-expiry'
+)
+game_expiry = ExpiryScheduler(
+    int(os.environ.get('GAME_TIMEOUT', 60 * 60)), expire_game, persist=games.touch,
+    persist_interval=int(os.environ.get('ACTIVITY_PERSIST_INTERVAL', 60)), name='game-expiry',
+)
 
 
 @bot.message_handler(func=lambda message: True, content_types=ALL_CONTENT_TYPES)
 def process_message(msg):
-    if msg.message_id in PROCESSED_MESSAGES:
+    started_at = time.perf_counter()
+    if deduplicator.is_duplicate(UpdateDeduplicator.message_key(msg)):
         return
-    PROCESSED_MESSAGES.add(msg.message_id)
-    bot.send_chat_action(msg.chat.id, 'typing')
 
     if msg.chat.type != "private":
         bot.reply_to(msg, "Я работаю только в приватных чатах. Удалите меня отсюда и напишите мне в личку!")
@@ -245,22 +985,33 @@ def process_message(msg):
     user_id = msg.from_user.id
     username = msg.from_user.username or 'Anonymous'
 
-    mongo_messages.insert_one({
+    inbound_log = {
         'user_id': user_id,
         'from_user': True,
         'text': text,
         'timestamp': datetime.utcnow(),
         'message_id': msg.message_id
-    })
-    print("got message: '{}' from user {} ({})".format(text, user_id, username))
+    }
+    logger.debug("got message: '%s' from user %s (%s)", text, user_id, username)
 
-    user_object = mongo_users.find_one({'user_id': user_id})
-    # todo: turn it into a class instead
+    user_object = user_cache.get(user_id)
     # todo: update userame, if it changes
-    user_filter = {'user_id': user_id}
 
+    command = normalize_command(text)
+    if user_object is not None and user_object.get('current_state') == STATE_IN_GAME and \
+            command in {ANY, COMMAND_NO_TEXT}:
+        # the most frequent case: a message within a game goes straight to the counterparty,
+        # without the "typing" round trip to Telegram, and the incoming message is logged together with the relay
+        ctx = MessageContext(msg, user_object, started_at, inbound_log=inbound_log)
+        label = relay_in_game(ctx)
+        for hook in TRANSITION_HOOKS:
+            hook(ctx, relay_in_game, label)
+        return
+
+    bot.send_chat_action(msg.chat.id, 'typing')
+    log_writer.insert(mongo_messages, inbound_log)
     if user_object is None:
-        mongo_users.insert_one(
+        user_cache.insert(
             {
                 'user_id': user_id,
                 'username': username,
@@ -274,255 +1025,64 @@ def process_message(msg):
         send_text_to_user(
             user_id, WELCOME_TEXT, reply_markup=render_markup([SUGGEST_SUBSCRIBE, SUGGEST_START_GAME])
         )
-        print("new user initialized")
+        MESSAGES_TOTAL.inc(branch='new user initialized')
+        logger.debug("new user initialized")
         return
-    print(user_object)
-
-    current_state = user_object.get('current_state')
-    current_role = user_object.get('current_role')
-    current_role_name = ROLES_DICT.get(current_role, 'undefined')
-    counterparty = user_object.get('counterparty')
-    counterparty_filter = {'user_id': counterparty}
-    game_id = user_object.get('game_id')
-
-    def add_game_log(log_event, log_text, log_sender_role=None):
-        if log_sender_role is None:
-            log_sender_role = current_role
-        print('add game log: event "{}", text "{}", role "{}"'.format(log_event, log_text, log_sender_role))
-        mongo_game_logs.insert_one({
-            'event': log_event,
-            'sender': user_id,
-            'receiver': counterparty,
-            'text': log_text,
-            'sender_role': log_sender_role,
-            'game_id': game_id,
-            'timestamp': datetime.now(),
-            'message_id': msg.message_id
-        })
-
-    suggested_suggests = get_suggests_for_user_object(user_object)
-    subscription_suggest = suggested_suggests[0]
-    game_suggests = suggested_suggests[1:]
-    default_markup = render_markup(suggested_suggests)
-
-    if not text:
-        send_text_to_user(
-            user_id,
-            '<i>Я пока не поддерживаю стикеры, фото и т.п.\nПожалуйста, пользуйтесь текстом и смайликами \U0001F642</i>',  # noqa
-            reply_markup=default_markup)
-        print("class: no text detected")
-    elif text == SUGGEST_SUBSCRIBE:
-        if user_object.get('allow_notifications'):
-            send_text_to_user(
-                user_id, '<i>Вы уже и так подписаны на обновления о новых игроках!</i>', reply_markup=default_markup,
-            )
-            print("class: subscribe, but already subscribed")
-        else:
-            mongo_users.update_one(user_filter, {'$set': {'allow_notifications': True}})
-            send_text_to_user(
-                user_id, '<i>Теперь вы подписаны на обновления о новых игроках!</i>',
-                reply_markup=render_markup([SUGGEST_UNSUBSCRIBE] + game_suggests)
-            )
-            print("class: subscribe successfully")
-    elif text == SUGGEST_UNSUBSCRIBE:
-        if not user_object.get('allow_notifications'):
-            send_text_to_user(
-                user_id, '<i>Вы уже и так отписаны от обновлений о новых игроках!</i>', reply_markup=default_markup
-            )
-            print("class: unsubscribe, but already unsubscribed")
-        else:
-            mongo_users.update_one(user_filter, {'$set': {'allow_notifications': False}})
-            send_text_to_user(
-                user_id, '<i>Теперь вы отписаны от обновлений о новых игроках.</i>',
-                reply_markup=render_markup([SUGGEST_SUBSCRIBE] + game_suggests)
-            )
-            print("class: unsubscribe successfully")
-    elif text == SUGGEST_START_GAME and current_state in STATES_OUTSIDE:
-        vacants = list(mongo_users.find({'current_state': STATE_ACTIVE}))
-        random.shuffle(vacants)
-        if len(vacants) > 0:
-            counterparty = vacants[0]['user_id']
-            game_id = str(uuid.uuid4())
-            if random.random() < 0.5:
-                new_role = ROLE_SELLER
-                new_counterparty_role = ROLE_BUYER
-            else:
-                new_role = ROLE_BUYER
-                new_counterparty_role = ROLE_SELLER
-            mongo_users.update_one(
-                user_filter,
-                {'$set': {'current_state': STATE_IN_GAME, 'current_role': new_role, 'counterparty': counterparty, 'game_id': game_id}}
-            )
-            mongo_users.update_one(
-                {'user_id': counterparty},
-                {'$set': {'current_state': STATE_IN_GAME, 'current_role': new_counterparty_role, 'counterparty': user_id, 'game_id': game_id}}
-            )
-            add_game_log(log_event='game_start', log_text=None, log_sender_role=new_role)
-            send_text_to_user(
-                user_id, INTRO_START_PREFIX + ROLES_INTRO_DICT[new_role],
-                reply_markup=render_markup(shuffled(ROLES_INITIAL_SUGGESTS_DICT[new_role]))
-            )
-            send_text_to_user(
-                counterparty,
-                INTRO_START_PREFIX + ROLES_INTRO_DICT[new_counterparty_role],
-                reply_markup=render_markup(shuffled(ROLES_INITIAL_SUGGESTS_DICT[new_counterparty_role]))
-            )
-            print("class: start new game successfully")
-        else:
-            if current_state != STATE_ACTIVE:
-                mongo_users.update_one(user_filter, {'$set': {'current_state': STATE_ACTIVE}})
-            for other_user_id in find_subscribed_users():
-                if other_user_id != user_id:
-                    send_text_to_user(other_user_id, '<i>Кто-то готов к новой игре! Вы можете присоединиться!</i>')
-            send_text_to_user(
-                user_id,
-                '<i>Сейчас нет свободных игроков. Игра начнётся, как только другой игрок будет готов.'
-                '\nЕсли вы не хотите начинать игру, как только другой игрок появится, нажмите "{}"</i>'.format(
-                    SUGGEST_NOT_START_GAME
-                ),
-                reply_markup=render_markup([subscription_suggest, SUGGEST_NOT_START_GAME]),
-            )
-            print("class: tried to start new game, but has no counterparty")
-    elif text == SUGGEST_START_GAME and current_state == STATE_IN_GAME:
-        send_text_to_user(
-            user_id, '<i>Вы и так уже в игре! Ваша роль - {}</i>'.format(current_role_name),
-            reply_markup=default_markup
-        )
-        print("class: tried to start new game, but already in a game")
-    elif text == SUGGEST_END_GAME and current_state in STATES_OUTSIDE:
-        send_text_to_user(
-            user_id,
-            '<i>Вы уже и так не играете. Нажмите "{}", чтобы не получать приглашения в следующие игры</i>'.format(
-                SUGGEST_UNSUBSCRIBE
-            ),
-            reply_markup=default_markup
-        )
-        print("class: tried to end a game, but already not in a game")
-    elif text == SUGGEST_END_GAME and current_state == STATE_IN_GAME and current_role == ROLE_SELLER:
-        add_game_log(log_event='game_end_by_seller', log_text=None)
-
-        mongo_users.update_one(user_filter, {'$set': {'current_state': STATE_FEEDBACK_WHY_NOT}})
-        send_text_to_user(
-            user_id,
-            '<i>Окей, вы завершили игру без сделки. Спасибо вам за эту игру!'
-            '\nПожалуйста, кратко расскажите в следующем сообщении, почему вы решили завершить игру?</i>',
-            reply_markup=[]
-        )
-
-        mongo_users.update_one(counterparty_filter, INACTIVE_UPDATE)
-        send_text_to_user(
-            counterparty,
-            '<i>Продавец решил завершить игру без сделки. '
-            '\nБольшое спасибо вам за игру! Приходите ещё \U0001F60A</i>'
-        )
-        print("class: game ended by seller unsuccessfully; ask seller why")
-    elif text == SUGGEST_DO_BUY and current_state == STATE_IN_GAME and current_role == ROLE_BUYER:
-        add_game_log(log_event='game_end_by_buyer_did_buy', log_text=None)
-
-        mongo_users.update_one(user_filter, {'$set': {'current_state': STATE_FEEDBACK_TERMS}})
-        send_text_to_user(
-            user_id,
-            '<i>Ура, вы согласились купить подписку!'
-            '\nПожалуйста, кратко опишите условия сделки '
-            '(на какой цене вы сошлись; какие особые условия, если они есть).'
-            '\nВажно: надо уложиться в одно сообщение.</i>',
-            reply_markup=render_markup([])
-        )
-
-        mongo_users.update_one(counterparty_filter, {'$set': {'current_state': STATE_FEEDBACK_TERMS}})
-        send_text_to_user(
-            counterparty,
-            '<i>Ура, ваш клиент согласился купить подписку!'
-            '\nПожалуйста, кратко опишите условия сделки '
-            '(на какой цене вы сошлись; какие особые условия, если они есть).'
-            '\nВажно: надо уложиться в одно сообщение.</i>',
-            reply_markup=render_markup([])
-        )
-        print("class: game ended by buyer successfully; ask buyer and seller about terms")
-    elif text == SUGGEST_NOT_BUY and current_state == STATE_IN_GAME and current_role == ROLE_BUYER:
-        add_game_log(log_event='game_end_by_buyer_did_not_buy', log_text=None)
-
-        mongo_users.update_one(user_filter, {'$set': {'current_state': STATE_FEEDBACK_WHY_NOT}})
-        send_text_to_user(
-            user_id,
-            '<i>Окей, вы завершили игру без сделки. Спасибо вам за эту игру!'
-            '\nПожалуйста, кратко расскажите в следующем сообщении, почему вы решили завершить игру?</i>',
-            reply_markup=[]
-        )
-
-        mongo_users.update_one(counterparty_filter, INACTIVE_UPDATE)
-        send_text_to_user(
-            counterparty,
-            '<i>Покупатель решил завершить игру без сделки. '
-            '\nБольшое спасибо вам за игру и обратную связь! Приходите ещё \U0001F60A</i>'
-        )
-        print("class: game ended by buyer unsuccessfully; ask buyer why")
-    elif current_state == STATE_FEEDBACK_TERMS or current_state == STATE_FEEDBACK_WHY_NOT:
-        if current_state == STATE_FEEDBACK_TERMS:
-            add_game_log(log_event='feedback_terms', log_text=text)
-        elif current_state == STATE_FEEDBACK_WHY_NOT:
-            add_game_log(log_event='feedback_why_not', log_text=text)
-        mongo_users.update_one(user_filter, INACTIVE_UPDATE)
-        send_text_to_user(
-            user_id,
-            '<i>Ага, понятно.\nБольшое спасибо вам за игру и обратную связь! Приходите ещё \U0001F60A</i>',
-            reply_markup=render_markup([subscription_suggest, SUGGEST_START_GAME])
-        )
-        print('class: terms feedback succesfully collected; game finally ended')
-    elif text == SUGGEST_NOT_START_GAME and current_state == STATE_IN_GAME:
-        send_text_to_user(
-            user_id,
-            '<i>Поздно! Вы уже в игре, ваша роль - {}.'
-            '\nПопробуйте пройти её до конца, а когда завершите, нажмите "{}"</i>'.format(
-                current_role_name,
-                SUGGEST_END_GAME
-            ),
-            reply_markup=default_markup
-        )
-        print("class: tried not to start game, but already in a game")
-    elif text == SUGGEST_NOT_START_GAME and current_state == STATE_INACTIVE:
-        send_text_to_user(
-            user_id,
-            '<i>Вы и так не начинаете игру. '
-            '\nПока вы сами не нажмёте "{}", игра не начнётся.'
-            '\nЕсли вы не хотите получать уведомления о новых игроках, готовых к игре, нажмите "{}"</i>'.format(
-                SUGGEST_START_GAME,
-                SUGGEST_UNSUBSCRIBE
-            ),
-            reply_markup=default_markup
-        )
-        print("class: tried not to start a game, but already inactive")
-    elif text == SUGGEST_NOT_START_GAME and current_state == STATE_ACTIVE:
-        mongo_users.update_one(user_filter, {'$set': {'current_state': STATE_INACTIVE}})
-        send_text_to_user(
-            user_id,
-            '<i>Хорошо, не будем начинать игру '
-            '\nНажмите, "{}", когда снова будете готовы начать игру.'
-            '\nЕсли вы не хотите получать уведомления о новых игроках, готовых к игре, нажмите "{}"</i>'.format(
-                SUGGEST_START_GAME,
-                SUGGEST_UNSUBSCRIBE
-            ),
-            reply_markup=render_markup([subscription_suggest, SUGGEST_START_GAME])
-        )
-        print("class: successfully decided not to start a game")
-    elif text == '/help':
-        if current_role == ROLE_BUYER:
-            send_text_to_user(user_id, INTRO_BUYER)
-            print('class: help to buyer')
-        elif current_role == ROLE_SELLER:
-            send_text_to_user(user_id, INTRO_SELLER)
-            print('class: help to seller')
-        else:
-            send_text_to_user(user_id, WELCOME_TEXT)
-            print('class: help outside game')
-    elif current_state == STATE_IN_GAME:
-        add_game_log(log_text=text, log_event='text')
-        send_text_to_user(counterparty, text)
-        print("class: some random text within a game; sent to the counterparty")
-    else:
-        # todo: болталка, вопросы, и всё такое
-        send_text_to_user(user_id, WELCOME_TEXT, reply_markup=default_markup)
-        print("class: some random text outside a game")
+    logger.debug('user object: %s', user_object)
+
+    for _ in range(MAX_TRANSITION_ATTEMPTS):
+        ctx = MessageContext(msg, user_object, started_at)
+        handler = find_transition(ctx.current_state, ctx.current_role, command)
+        try:
+            label = handler(ctx)
+        except TransitionConflict as exc:
+            # the state has been changed by a concurrent request: read it again and choose the transition anew
+            logger.info('transition conflict for user %s: %s', user_id, exc)
+            user_cache.forget(user_id)
+            if ctx.counterparty is not None:
+                user_cache.forget(ctx.counterparty)
+            user_object = user_cache.get(user_id)
+            continue
+        for hook in TRANSITION_HOOKS:
+            hook(ctx, handler, label)
+        return
+    logger.warning('gave up processing message %s of user %s after repeated conflicts', msg.message_id, user_id)
+
+
+def run_phase(name, function, attempts=1, backoff=1):
+    """ Run one phase of the startup; a failure is logged, and does not stop the phases after it """
+    with startup.phase(name):
+        for attempt in range(1, attempts + 1):
+            try:
+                function()
+                return True
+            except Exception:
+                if attempt == attempts:
+                    logger.exception('startup phase "%s" has failed', name)
+                    return False
+                logger.warning('startup phase "%s" has failed, retrying in %s s', name, backoff, exc_info=True)
+                time.sleep(backoff)
+                backoff *= 2
+
+
+def prepare(register_webhook=True):
+    """ The startup work that can go on while the first updates are already being served """
+    if register_webhook:
+        # a woken up dyno may not reach Telegram at once; web_hook() checks the webhook again on every wake-up
+        run_phase('webhook', ensure_webhook, attempts=5)
+    run_phase('mongo connection', lambda: mongo_db.command('ping'), attempts=3)
+    run_phase('indexes', lambda: ensure_indexes(mongo_db))
+    run_phase('queue backfill', matchmaker.backfill)
+    run_phase('waiting recovery', lambda: waiting_expiry.recover(matchmaker.iter_activity()))
+    run_phase('game recovery', lambda: game_expiry.recover(games.iter_activity()))
+    startup.report()
+
+
+def exit_on_signal(signum, frame):
+    # the web server does not stop on SIGTERM by itself; SystemExit stops it and runs the atexit handlers,
+    # which process the accepted updates, send the queued messages and write the buffered logs
+    logger.info('got signal %s, stopping', signum)
+    raise SystemExit(0)
 
 
 def main():
@@ -532,11 +1092,20 @@ def main():
     args = parser.parse_args()
     if args.poll:
         bot.remove_webhook()
-        bot.polling()
+        prepare(register_webhook=False)
+        engine = PollingEngine(
+            bot, update_pool, get_update_key,
+            limit=int(os.environ.get('POLL_BATCH_SIZE', 100)), timeout=int(os.environ.get('POLL_TIMEOUT', 20)),
+        )
+        engine.install_signal_handlers()
+        engine.run()
     else:
-        web_hook()
+        signal.signal(signal.SIGTERM, exit_on_signal)
+        threading.Thread(target=prepare, name='prepare', daemon=True).start()
         server.run(host="0.0.0.0", port=int(os.environ.get('PORT', 5000)))
 
 
+startup.mark('module')
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+import logging
+import pymongo
+
+from datetime import datetime
+from games import TransitionConflict
+from transactions import run_in_transaction
+
+logger = logging.getLogger(__name__)
+
+
+class Matchmaker:
+    """
+    A FIFO queue of players waiting for a game, stored in its own collection.
+    A waiting player is claimed with a single atomic find_one_and_delete,
+    so two concurrent workers can never pair the same counterparty twice.
+    """
+    def __init__(self, client, users_collection, queue_collection, waiting_state, game_state, games=None):
+        self.client = client
+        self.users = users_collection
+        # an optional GameStore, where the game document is created together with the pairing
+        self.games = games
+        # user_id, enqueued_at, last_activity
+        self.queue = queue_collection
+        self.waiting_state = waiting_state
+        self.game_state = game_state
+
+    def join(self, user_id):
+        now = datetime.utcnow()
+        self.queue.update_one(
+            {'user_id': user_id},
+            {'$setOnInsert': {'user_id': user_id, 'enqueued_at': now}, '$set': {'last_activity': now}},
+            upsert=True,
+        )
+
+    def leave(self, user_id):
+        self.queue.delete_one({'user_id': user_id})
+
+    def is_waiting(self, user_id):
+        return self.queue.find_one({'user_id': user_id}, {'_id': 1}) is not None
+
+    def backfill(self):
+        """ Put into the queue the waiting users that were there before the queue existed """
+        now = datetime.utcnow()
+        for user_object in self.users.find({'current_state': self.waiting_state}, {'user_id': 1}):
+            self.queue.update_one(
+                {'user_id': user_object['user_id']},
+                {'$setOnInsert': {'user_id': user_object['user_id'], 'enqueued_at': now, 'last_activity': now}},
+                upsert=True,
+            )
+
+    def iter_activity(self):
+        """ (user_id, last_activity) of all the waiting players """
+        for entry in self.queue.find({}, {'user_id': 1, 'enqueued_at': 1, 'last_activity': 1}):
+            yield entry['user_id'], entry.get('last_activity') or entry['enqueued_at']
+
+    def expire(self, user_id, cutoff):
+        """ Take user_id out of the queue if they have been idle since cutoff; return False if they have not """
+        result = self.queue.delete_one({'user_id': user_id, '$or': [
+            {'last_activity': {'$lte': cutoff}},
+            {'last_activity': {'$exists': False}, 'enqueued_at': {'$lte': cutoff}},
+        ]})
+        return result.deleted_count > 0
+
+    def claim(self, user_id, joined_at=None):
+        """
+        Atomically take the queue entry of the longest-waiting player other than user_id out of the queue.
+        If joined_at is given, claim only a player who has joined before user_id did, at joined_at.
+        """
+        query = {'user_id': {'$ne': user_id}}
+        if joined_at is not None:
+            query['$or'] = [
+                {'enqueued_at': {'$lt': joined_at}},
+                {'enqueued_at': joined_at, 'user_id': {'$lt': user_id}},
+            ]
+        return self.queue.find_one_and_delete(query, sort=[('enqueued_at', pymongo.ASCENDING)])
+
+    def requeue(self, entry):
+        """ Put a claimed entry back, keeping its place in the queue """
+        entry = {key: value for key, value in entry.items() if key != '_id'}
+        self.queue.update_one({'user_id': entry['user_id']}, {'$setOnInsert': entry}, upsert=True)
+
+    def pair(self, user_id, counterparty, game_id, role, counterparty_role):
+        """
+        Write the game into both user documents at once; return False if the counterparty is no longer waiting.
+        Raise TransitionConflict if user_id has been paired by someone else in the meantime.
+        """
+        def write_both(session):
+            result = self.users.update_one(
+                {'user_id': counterparty, 'current_state': self.waiting_state},
+                {'$set': {
+                    'current_state': self.game_state, 'current_role': counterparty_role,
+                    'counterparty': user_id, 'game_id': game_id,
+                }},
+                session=session,
+            )
+            if result.matched_count == 0:
+                return False
+            result = self.users.update_one(
+                {'user_id': user_id, 'current_state': {'$ne': self.game_state}},
+                {'$set': {
+                    'current_state': self.game_state, 'current_role': role,
+                    'counterparty': counterparty, 'game_id': game_id,
+                }},
+                session=session,
+            )
+            if result.matched_count == 0:
+                if session is None:
+                    # without a transaction, the counterparty has to be put back into the waiting state by hand
+                    self.users.update_one(
+                        {'user_id': counterparty, 'game_id': game_id},
+                        {'$set': {
+                            'current_state': self.waiting_state, 'current_role': None,
+                            'counterparty': None, 'game_id': None,
+                        }},
+                    )
+                raise TransitionConflict('user {} has been paired by someone else'.format(user_id))
+            if self.games is not None:
+                self.games.create(game_id, {role: user_id, counterparty_role: counterparty}, session=session)
+            return True
+        return run_in_transaction(self.client, write_both)
+
+    def find_partner(self, user_id, game_id, choose_roles, joined=False):
+        """
+        Claim a waiting player and start a game with them; choose_roles(user_id, counterparty) returns their roles.
+        Return (counterparty, role, counterparty_role), or None if nobody is waiting.
+        Raise TransitionConflict if user_id has been paired by someone else in the meantime.
+        With joined=True, user_id has just joined the queue after finding nobody, and looks once more:
+        of two players who have started at the same time, the one who has joined later claims the other.
+        """
+        if joined:
+            # stay in the queue, so that a player who has joined earlier is never left without a partner
+            own_entry = self.queue.find_one({'user_id': user_id})
+            if own_entry is None:
+                # claimed by another player, who is starting the game
+                return None
+            joined_at = own_entry['enqueued_at']
+        else:
+            # leave the queue first, so that nobody can claim user_id while they are claiming someone else
+            own_entry = self.queue.find_one_and_delete({'user_id': user_id})
+            joined_at = None
+        while True:
+            entry = self.claim(user_id, joined_at=joined_at)
+            if entry is None:
+                if own_entry is not None and not joined:
+                    self.requeue(own_entry)
+                return None
+            counterparty = entry['user_id']
+            role, counterparty_role = choose_roles(user_id, counterparty)
+            try:
+                paired = self.pair(user_id, counterparty, game_id, role, counterparty_role)
+            except TransitionConflict:
+                self.requeue(entry)
+                raise
+            if paired:
+                if joined:
+                    self.leave(user_id)
+                return counterparty, role, counterparty_role
+            logger.info('skipping stale queue entry of user %s', counterparty)
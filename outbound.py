@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from collections import deque
+from telebot.apihelper import ApiTelegramException
+
+logger = logging.getLogger(__name__)
+
+
+# Telegram allows about 30 messages per second in total, and about one message per second in a single chat
+GLOBAL_RATE = 30
+GLOBAL_BURST = 30
+CHAT_RATE = 1
+CHAT_BURST = 3
+MAX_RETRIES = 5
+# background jobs (e.g. broadcasts) may use at most this share of the global rate, and only when no interactive job is ready
+BACKGROUND_SHARE = 0.5
+
+LANE_INTERACTIVE = 0
+LANE_BACKGROUND = 1
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.timestamp = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+
+    def wait_time(self, now=None):
+        """ How many seconds should pass before a token is available (0 if it is available right now) """
+        now = now or time.monotonic()
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+    def is_full(self, now=None):
+        self._refill(now or time.monotonic())
+        return self.tokens >= self.capacity
+
+
+def get_retry_after(exc):
+    """ Extract the number of seconds to wait from a Telegram 429 error, or None for all other errors """
+    if isinstance(exc, ApiTelegramException) and exc.error_code == 429:
+        parameters = (exc.result_json or {}).get('parameters') or {}
+        return parameters.get('retry_after', 1)
+    return None
+
+
+class OutboundJob:
+    def __init__(self, function, args, kwargs, on_success=None, on_failure=None):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.on_success = on_success
+        self.on_failure = on_failure
+        self.attempts = 0
+
+
+class OutboundDispatcher:
+    """
+    Sends outgoing Telegram requests from a pool of background threads.
+    Jobs for the same chat are executed strictly in the order they were enqueued, one at a time;
+    jobs for different chats run in parallel, within the global and the per-chat rate limits.
+    Background jobs go to a separate lane, which is served only when no interactive job is ready,
+    and within its own share of the global rate, so that a large broadcast does not delay the games.
+    The order of a chat's jobs is kept within each lane.
+    """
+    def __init__(
+            self, num_workers=8, global_rate=GLOBAL_RATE, global_burst=GLOBAL_BURST,
+            chat_rate=CHAT_RATE, chat_burst=CHAT_BURST, max_retries=MAX_RETRIES, background_share=BACKGROUND_SHARE,
+    ):
+        self.num_workers = num_workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.background_bucket = TokenBucket(global_rate * background_share, max(1, global_burst * background_share))
+        self.chat_buckets = {}
+        # (lane, chat_id) -> deque of pending jobs; a key is present here iff it is either scheduled or in flight
+        self.queues = {}
+        # lane -> heap of (ready_time, seq, chat_id) for chats that have pending jobs in the lane and are not in flight
+        self.schedules = {LANE_INTERACTIVE: [], LANE_BACKGROUND: []}
+        self.counter = itertools.count()
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.workers = []
+        self.stopped = False
+
+    def start(self):
+        with self.condition:
+            if self.workers:
+                return
+            self.stopped = False
+            for i in range(self.num_workers):
+                worker = threading.Thread(target=self._work, name='outbound-{}'.format(i), daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+    def enqueue(self, chat_id, function, *args, on_success=None, on_failure=None, background=False, **kwargs):
+        """
+        Call function(*args, **kwargs), then on_success(result), or on_failure(exception) if it finally fails.
+        With background=True, the job goes to the low-priority lane.
+        """
+        if not self.workers:
+            self.start()
+        job = OutboundJob(function, args, kwargs, on_success=on_success, on_failure=on_failure)
+        key = (LANE_BACKGROUND if background else LANE_INTERACTIVE, chat_id)
+        with self.condition:
+            if key not in self.queues:
+                self.queues[key] = deque()
+                self._schedule(key, time.monotonic())
+            self.queues[key].append(job)
+            self.condition.notify()
+
+    def queue_depth(self):
+        with self.condition:
+            return sum(len(q) for q in self.queues.values())
+
+    def flush(self, timeout=None):
+        """ Block until all enqueued jobs are sent; return False if the timeout has expired before that """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while self.queues:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def stop(self, timeout=None):
+        self.flush(timeout=timeout)
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        for worker in self.workers:
+            worker.join(timeout=1)
+        self.workers = []
+
+    def _schedule(self, key, ready_time):
+        lane, chat_id = key
+        heapq.heappush(self.schedules[lane], (ready_time, next(self.counter), chat_id))
+
+    def _next_job(self):
+        with self.condition:
+            while True:
+                if self.stopped:
+                    return None, None
+                now = time.monotonic()
+                heads = [(self.schedules[lane][0][0], lane) for lane in (LANE_INTERACTIVE, LANE_BACKGROUND)
+                         if self.schedules[lane]]
+                if not heads:
+                    self.condition.wait()
+                    continue
+                # the interactive lane goes first whenever it has a ready chat; otherwise wait for the earliest one
+                ready = [lane for ready_time, lane in heads if ready_time <= now]
+                if not ready:
+                    self.condition.wait(min(heads)[0] - now)
+                    continue
+                lane = min(ready)
+                _, _, chat_id = heapq.heappop(self.schedules[lane])
+                key = (lane, chat_id)
+                chat_bucket = self.chat_buckets.get(chat_id)
+                if chat_bucket is None:
+                    chat_bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+                buckets = [chat_bucket, self.global_bucket]
+                if lane == LANE_BACKGROUND:
+                    buckets.append(self.background_bucket)
+                wait = max(bucket.wait_time(now) for bucket in buckets)
+                if wait > 0:
+                    self._schedule(key, now + wait)
+                    continue
+                for bucket in buckets:
+                    bucket.consume()
+                self.in_flight += 1
+                return key, self.queues[key][0]
+
+    def _finish(self, key, done, delay=0):
+        with self.condition:
+            self.in_flight -= 1
+            queue = self.queues[key]
+            if done:
+                queue.popleft()
+            if queue:
+                self._schedule(key, time.monotonic() + delay)
+            else:
+                del self.queues[key]
+                self._forget_idle_buckets()
+            self.condition.notify_all()
+
+    def _forget_idle_buckets(self):
+        # keep the per-chat buckets dict bounded by the number of recently active chats
+        if len(self.chat_buckets) > 10 * max(1, len(self.queues)) + 1000:
+            now = time.monotonic()
+            active = {chat_id for _, chat_id in self.queues}
+            for chat_id in [c for c, b in self.chat_buckets.items() if c not in active and b.is_full(now)]:
+                del self.chat_buckets[chat_id]
+
+    def _work(self):
+        while True:
+            key, job = self._next_job()
+            if job is None:
+                return
+            chat_id = key[1]
+            job.attempts += 1
+            try:
+                result = job.function(*job.args, **job.kwargs)
+            except Exception as exc:
+                retry_after = get_retry_after(exc)
+                if retry_after is not None and job.attempts <= self.max_retries:
+                    logger.warning('got 429 for chat %s, retrying in %s s', chat_id, retry_after)
+                    self._finish(key, done=False, delay=retry_after)
+                else:
+                    logger.error('failed to send to chat %s: %s', chat_id, exc)
+                    self._callback(chat_id, job.on_failure, exc)
+                    self._finish(key, done=True)
+                continue
+            self._callback(chat_id, job.on_success, result)
+            self._finish(key, done=True)
+
+    @staticmethod
+    def _callback(chat_id, callback, argument):
+        if callback is None:
+            return
+        try:
+            callback(argument)
+        except Exception:
+            logger.exception('failed to process the result of sending to chat %s', chat_id)
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import logging
+import signal
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class PollingInterrupted(BaseException):
+    """ Raised by the signal handler to stop waiting for new updates; like KeyboardInterrupt, not an Exception """
+
+
+class PollingEngine:
+    """
+    Receives updates with getUpdates in batches of up to `limit` and processes each batch on a worker pool,
+    which keeps the order of updates with the same key.
+    The offset that confirms a batch to Telegram is sent only after the whole batch has been processed,
+    so updates that were received but not processed (e.g. because of a crash) are delivered again.
+    After SIGTERM or SIGINT the engine finishes the current batch, confirms it, and returns from run().
+    """
+    def __init__(self, bot, pool, get_key, limit=100, timeout=20, allowed_updates=None, max_backoff=30):
+        self.bot = bot
+        self.pool = pool
+        self.get_key = get_key
+        self.limit = limit
+        self.timeout = timeout
+        self.allowed_updates = allowed_updates
+        self.max_backoff = max_backoff
+        # the id of the first update that has not been processed yet
+        self.offset = None
+        self.stopping = False
+        self.fetching = False
+        self.processed = 0
+
+    def stop(self, *args):
+        self.stopping = True
+        if self.fetching:
+            # a long poll may take `timeout` seconds, and no updates are being processed now
+            raise PollingInterrupted()
+
+    def install_signal_handlers(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+    def fetch(self):
+        self.fetching = True
+        try:
+            if self.stopping:
+                raise PollingInterrupted()
+            # in telebot, `timeout` is the timeout of the HTTP request, and `long_polling_timeout` is that of getUpdates
+            return self.bot.get_updates(
+                offset=self.offset, limit=self.limit, timeout=self.timeout + 5,
+                allowed_updates=self.allowed_updates, long_polling_timeout=self.timeout,
+            )
+        finally:
+            self.fetching = False
+
+    def process_batch(self, updates):
+        for update in updates:
+            # submit() returns False only if the pool rejects items; the update must not be lost anyway
+            while not self.pool.submit(self.get_key(update), update):
+                time.sleep(0.1)
+        self.pool.join()
+        self.offset = updates[-1].update_id + 1
+        self.processed += len(updates)
+
+    def run(self):
+        backoff = 1
+        logger.info('started polling')
+        while not self.stopping:
+            try:
+                updates = self.fetch()
+            except PollingInterrupted:
+                break
+            except Exception as exc:
+                logger.error('failed to get updates: %s; retrying in %s s', exc, backoff)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            backoff = 1
+            if updates:
+                logger.debug('got %s updates', len(updates))
+                self.process_batch(updates)
+        self.commit()
+        logger.info('stopped polling after %s updates', self.processed)
+
+    def commit(self):
+        """ Confirm the processed updates to Telegram without waiting for new ones """
+        if self.offset is None:
+            return
+        try:
+            # telebot replaces a zero long_polling_timeout with its default, so wait for at most a second
+            self.bot.get_updates(offset=self.offset, limit=1, timeout=5, long_polling_timeout=1)
+        except Exception as exc:
+            logger.error('failed to confirm the processed updates: %s', exc)
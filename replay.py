@@ -0,0 +1,272 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Replays the recorded history of incoming messages through the real webhook of main.py.
+Updates are rebuilt from the inbound records of the messages collection (hot and archived) of the source database;
+Telegram is replaced with FakeTelegramApi, and Mongo is mongomock (or a local mongod, if --mongo is given).
+Reports the latency and the throughput by branch, and compares the replayed outgoing messages and game events
+with the recorded ones, user by user.
+
+    python replay.py --source mongodb://... --since 2026-09-01 --until 2026-09-02 --speed 100 --output replay.json
+
+--speed 1 keeps the original pacing, --speed 100 compresses the time 100 times, and --speed 0 sends as fast as possible.
+Every user starts from scratch, so a replayed period should start when its users were not in the middle of a game.
+Players who were paired in the recorded history get the same roles, but the pairing itself may differ,
+as it depends on the timing.
+"""
+import argparse
+import difflib
+import json
+import os
+import threading
+import time
+
+from archive import Archive
+from collections import Counter, defaultdict, deque
+from datetime import datetime
+from export import build_query
+from fake_telegram import FakeTelegramApi
+from loadtest import MongoOpCounter, summarize
+from pymongo import MongoClient
+
+DIFF_SAMPLES = 5
+
+
+class RecordedRoles:
+    """ Gives the players of each replayed game the roles they had in the recorded game, instead of random ones """
+    def __init__(self, events, fallback):
+        self.fallback = fallback
+        # (user who started the game, counterparty) -> roles of the starter in their games, in the order of time
+        self.roles = defaultdict(deque)
+        for event in events:
+            if event['event'] == 'game_start':
+                self.roles[(event['sender'], event['receiver'])].append(event['sender_role'])
+        self.lock = threading.Lock()
+
+    def __call__(self, user_id, counterparty):
+        with self.lock:
+            recorded = self.roles.get((user_id, counterparty))
+            role = recorded.popleft() if recorded else None
+        if role is None:
+            return self.fallback(user_id, counterparty)
+        return role, 'buyer' if role == 'seller' else 'seller'
+
+
+def load_history(source_db, since=None, until=None, limit=None):
+    """ The recorded inbound messages, the outbound messages, and the game events of the period, ordered by time """
+    archive = Archive(source_db)
+    messages = list(archive.iter_documents('messages', build_query(since, until), limit=limit, since=since, until=until))
+    messages.sort(key=lambda m: (m['timestamp'], m['_id']))
+    inbound = [m for m in messages if m.get('from_user')]
+    user_ids = {m['user_id'] for m in inbound}
+    outbound = [m for m in messages if not m.get('from_user') and m['user_id'] in user_ids]
+    # game_logs timestamps are local, and messages timestamps are UTC
+    offset = datetime.now() - datetime.utcnow()
+    local_since = since and since + offset
+    local_until = until and until + offset
+    events = [
+        e for e in archive.iter_documents(
+            'game_logs', build_query(local_since, local_until), since=local_since, until=local_until,
+        )
+        if e.get('sender') in user_ids
+    ]
+    events.sort(key=lambda e: (e['timestamp'], e['_id']))
+    usernames = {
+        u['user_id']: u.get('username')
+        for u in source_db.get_collection('users').find({'user_id': {'$in': list(user_ids)}}, {'user_id': 1, 'username': 1})
+    }
+    return inbound, outbound, events, usernames
+
+
+def build_update(update_id, record, username=None):
+    """ A Telegram update (as JSON) with the recorded incoming message """
+    user_id = record['user_id']
+    message = {
+        'message_id': record['message_id'], 'date': int(record['timestamp'].timestamp()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'Player', 'username': username},
+    }
+    if record.get('text') is not None:
+        message['text'] = record['text']
+    else:
+        # the content of non-text messages is not recorded
+        message['sticker'] = {
+            'file_id': 'replay', 'file_unique_id': 'replay', 'width': 512, 'height': 512,
+            'is_animated': False, 'is_video': False, 'type': 'regular',
+        }
+    return json.dumps({'update_id': update_id, 'message': message})
+
+
+def compare_sequences(recorded, replayed):
+    """ Compare two dicts user_id -> list of items; report how many items match, and the first differences """
+    matched = 0
+    identical = 0
+    samples = []
+    for user_id in sorted(set(recorded) | set(replayed)):
+        expected = recorded.get(user_id, [])
+        actual = replayed.get(user_id, [])
+        matcher = difflib.SequenceMatcher(a=expected, b=actual, autojunk=False)
+        matched += sum(block.size for block in matcher.get_matching_blocks())
+        if expected == actual:
+            identical += 1
+        elif len(samples) < DIFF_SAMPLES:
+            position = next((i for i, (e, a) in enumerate(zip(expected, actual)) if e != a), min(len(expected), len(actual)))
+            samples.append({
+                'user_id': user_id, 'position': position,
+                'recorded': expected[position] if position < len(expected) else None,
+                'replayed': actual[position] if position < len(actual) else None,
+            })
+    total_recorded = sum(len(items) for items in recorded.values())
+    total_replayed = sum(len(items) for items in replayed.values())
+    return {
+        'users': len(set(recorded) | set(replayed)),
+        'identical_users': identical,
+        'recorded': total_recorded,
+        'replayed': total_replayed,
+        'matched': matched,
+        'match_ratio': 2 * matched / (total_recorded + total_replayed) if total_recorded + total_replayed else None,
+        'first_differences': samples,
+    }
+
+
+class Replay:
+    def __init__(self, main_module, api):
+        self.main = main_module
+        self.api = api
+        self.lock = threading.Lock()
+        # (user_id, message_id) -> time of posting, and the recorded inbound texts, to resolve copied messages
+        self.posted_at = {}
+        self.inbound_texts = {}
+        self.webhook_latencies = []
+        self.branch_latencies = defaultdict(list)
+        main_module.on_transition(self._record_transition)
+
+    def _record_transition(self, ctx, handler, label):
+        finished = time.monotonic()
+        with self.lock:
+            posted = self.posted_at.pop((ctx.user_id, ctx.msg.message_id), None)
+            if posted is not None:
+                self.branch_latencies[label].append(finished - posted)
+
+    def run(self, inbound, usernames, speed=0, max_gap=None):
+        client = self.main.server.test_client()
+        url = '/' + self.main.TELEBOT_URL + self.main.TOKEN
+        started = time.monotonic()
+        previous = None
+        schedule = 0
+        for update_id, record in enumerate(inbound, start=1):
+            if speed and previous is not None:
+                gap = (record['timestamp'] - previous).total_seconds() / speed
+                schedule += gap if max_gap is None else min(gap, max_gap)
+                delay = started + schedule - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            previous = record['timestamp']
+            key = (record['user_id'], record['message_id'])
+            self.inbound_texts[key] = record.get('text')
+            posted = time.monotonic()
+            with self.lock:
+                self.posted_at[key] = posted
+            client.post(url, data=build_update(update_id, record, usernames.get(record['user_id'])))
+            self.webhook_latencies.append(time.monotonic() - posted)
+        self.main.update_pool.join()
+        processed = time.monotonic() - started
+        # the outgoing messages are sent within the Telegram rate limits, so they may take longer
+        self.main.outbound.flush(timeout=60)
+        self.main.log_writer.flush()
+        return processed, time.monotonic() - started
+
+    def replayed_outbound(self):
+        result = {}
+        for chat_id, messages in list(self.api.messages.items()):
+            texts = []
+            for message in messages:
+                if message['method'] == 'copyMessage':
+                    params = message['params']
+                    texts.append(self.inbound_texts.get((int(params['from_chat_id']), int(params['message_id']))))
+                else:
+                    texts.append(message['text'])
+            result[chat_id] = texts
+        return result
+
+
+def run(args):
+    os.environ.setdefault('TOKEN', '123456:replay')
+    source_db = MongoClient(args.source).get_default_database()
+    since = datetime.fromisoformat(args.since) if args.since else None
+    until = datetime.fromisoformat(args.until) if args.until else None
+    inbound, outbound, events, usernames = load_history(source_db, since, until, limit=args.limit)
+
+    if args.mongo:
+        os.environ['MONGODB_URI'] = args.mongo
+    else:
+        os.environ.pop('MONGODB_URI', None)
+    api = FakeTelegramApi(latency=args.latency).start()
+
+    import telebot
+    telebot.apihelper.API_URL = api.api_url
+    import main
+
+    # main wraps its collections, so the class of a raw collection is instrumented
+    counter = MongoOpCounter(type(main.mongo_db.get_collection('users')))
+    counter.install()
+    replay = Replay(main, api)
+    main.choose_roles = RecordedRoles(events, main.choose_roles)
+    elapsed, elapsed_with_sending = replay.run(inbound, usernames, speed=args.speed, max_gap=args.max_gap)
+    counter.uninstall()
+
+    recorded_outbound = defaultdict(list)
+    for message in outbound:
+        recorded_outbound[message['user_id']].append(message.get('text'))
+    recorded_events = defaultdict(list)
+    for event in events:
+        recorded_events[event['sender']].append(event['event'])
+    replayed_events = defaultdict(list)
+    for event in main.mongo_game_logs.find({'sender': {'$ne': None}}).sort([('timestamp', 1), ('_id', 1)]):
+        replayed_events[event['sender']].append(event['event'])
+
+    updates = len(inbound)
+    results = {
+        'parameters': vars(args),
+        'updates': updates,
+        'elapsed': elapsed,
+        'elapsed_with_sending': elapsed_with_sending,
+        'updates_per_second': updates / elapsed if elapsed else None,
+        'webhook_latency': summarize(replay.webhook_latencies),
+        'branch_latency': {label: summarize(values) for label, values in replay.branch_latencies.items()},
+        'branch_throughput': {label: len(values) / elapsed for label, values in replay.branch_latencies.items()},
+        'mongo_ops_per_update': counter.total() / updates if updates else None,
+        'telegram_calls': dict(api.call_counts),
+        'outbound_diff': compare_sequences(recorded_outbound, replay.replayed_outbound()),
+        'transitions_diff': compare_sequences(recorded_events, replayed_events),
+        'events': {
+            'recorded': dict(Counter(event['event'] for event in events)),
+            'replayed': dict(Counter(e for items in replayed_events.values() for e in items)),
+        },
+    }
+    api.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay the recorded incoming messages through the bot')
+    parser.add_argument('--source', required=True, help='MongoDB URI of the database with the recorded history')
+    parser.add_argument('--since', help='start of the replayed period (UTC, ISO format)')
+    parser.add_argument('--until', help='end of the replayed period (UTC, ISO format)')
+    parser.add_argument('--limit', type=int, help='replay at most this many recorded messages')
+    parser.add_argument('--speed', type=float, default=0, help='1 for the original pacing, 0 for no pauses')
+    parser.add_argument('--max-gap', type=float, help='the longest pause between two updates, seconds')
+    parser.add_argument('--latency', type=float, default=0.02, help='latency of the fake Telegram API, seconds')
+    parser.add_argument('--mongo', help='MongoDB URI to replay into (by default, mongomock)')
+    parser.add_argument('--output', help='save the results as JSON to this file')
+    args = parser.parse_args()
+
+    results = run(args)
+    print(json.dumps(results, indent=2, ensure_ascii=False, default=str))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False, default=str)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class LazyProxy:
+    """ Creates the object with factory() on the first access to any of its attributes, and then stands for it """
+    def __init__(self, factory):
+        self._factory = factory
+        self._target = None
+        self._lock = threading.Lock()
+
+    def _resolve(self):
+        if self._target is None:
+            with self._lock:
+                if self._target is None:
+                    self._target = self._factory()
+        return self._target
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __getitem__(self, key):
+        # special methods are looked up on the class, bypassing __getattr__
+        return self._resolve()[key]
+
+
+def _clock():
+    try:
+        return time.clock_gettime(time.CLOCK_BOOTTIME)
+    except AttributeError:
+        return time.monotonic()
+
+
+def process_started_at():
+    """ The start of the current process on the _clock() scale, or None where /proc is not available """
+    try:
+        with open('/proc/self/stat') as stat:
+            # the process name in parentheses may contain spaces; starttime is the 22nd field
+            fields = stat.read().rsplit(')', 1)[1].split()
+        return int(fields[19]) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class StartupTimer:
+    """ Durations of the consecutive startup phases, from the start of the process """
+    def __init__(self):
+        self.started_at = process_started_at() or _clock()
+        self.last = self.started_at
+        self.phases = []
+        # from the start of the process to the report
+        self.total = None
+        self.lock = threading.Lock()
+
+    def mark(self, name):
+        """ Record that the phase `name` has ended now """
+        with self.lock:
+            now = _clock()
+            self.phases.append((name, now - self.last))
+            self.last = now
+
+    @contextmanager
+    def phase(self, name):
+        """ Record a phase that does not start where the previous one has ended, e.g. in a background thread """
+        started = _clock()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases.append((name, _clock() - started))
+
+    def as_dict(self):
+        with self.lock:
+            result = {name: round(seconds, 3) for name, seconds in self.phases}
+            if self.total is not None:
+                result['total'] = round(self.total, 3)
+        return result
+
+    def report(self):
+        with self.lock:
+            self.total = _clock() - self.started_at
+            phases = ', '.join('{} {:.3f} s'.format(name, seconds) for name, seconds in self.phases)
+        logger.info('startup took %.3f s: %s', self.total, phases)
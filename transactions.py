@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from pymongo.errors import ConfigurationError, OperationFailure
+
+logger = logging.getLogger(__name__)
+
+
+_TRANSACTIONS_SUPPORTED = {}
+
+
+def run_in_transaction(client, callback):
+    """
+    Run callback(session) inside a multi-document transaction, if the deployment supports them.
+    Otherwise (standalone mongod, mongomock), run callback(None) and rely on the conditional updates it does.
+    """
+    key = id(client)
+    if _TRANSACTIONS_SUPPORTED.get(key, True):
+        try:
+            with client.start_session() as session:
+                return session.with_transaction(callback)
+        except (NotImplementedError, ConfigurationError) as exc:
+            logger.info('transactions are not supported: %s', exc)
+            _TRANSACTIONS_SUPPORTED[key] = False
+        except OperationFailure as exc:
+            # code 20 (IllegalOperation): transactions are only allowed on replica sets and mongos
+            if exc.code != 20:
+                raise
+            logger.info('transactions are not supported: %s', exc)
+            _TRANSACTIONS_SUPPORTED[key] = False
+    return callback(None)
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import threading
+import time
+import uuid
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+INVALIDATIONS_TTL = 60 * 60
+
+
+class UserCache:
+    """
+    A bounded LRU cache of user documents keyed by user_id, with a TTL on every entry.
+    All writes to the users collection should go through it, so that the cached copies stay up to date.
+    """
+    def __init__(self, collection, max_size=10000, ttl=600, channel=None):
+        self.collection = collection
+        self.max_size = max_size
+        self.ttl = ttl
+        self.channel = channel
+        self.entries = OrderedDict()
+        # user_id -> [changes since the reads began, reads in flight], only for the users being read from the database,
+        # so that a document read before a change is not cached after it
+        self.reads = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if channel is not None:
+            channel.subscribe(self.forget)
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None and entry[1] > now:
+                self.entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            read = self.reads.get(user_id)
+            if read is None:
+                read = self.reads[user_id] = [0, 0]
+            read[1] += 1
+            changes = read[0]
+        user_object = None
+        try:
+            user_object = self.collection.find_one({'user_id': user_id})
+        finally:
+            with self.lock:
+                read[1] -= 1
+                if read[1] == 0:
+                    del self.reads[user_id]
+                # if the user has been changed while the document was being read, it may be stale
+                if user_object is not None and read[0] == changes:
+                    self._store(user_id, user_object)
+        return user_object
+
+    def insert(self, user_object):
+        self.collection.insert_one(user_object)
+        self._put(user_object['user_id'], user_object)
+        self._publish(user_object['user_id'])
+
+    def update(self, user_id, update, extra_filter=None, session=None):
+        """ Run update_one on the user and apply the same update to the cached copy """
+        user_filter = {'user_id': user_id}
+        if extra_filter:
+            user_filter.update(extra_filter)
+        result = self.collection.update_one(user_filter, update, session=session)
+        if result.matched_count:
+            self.apply(user_id, update)
+        else:
+            self.forget(user_id)
+        return result
+
+    def apply(self, user_id, update):
+        """ Reflect in the cache an update that has already been written to the database """
+        set_fields = update.get('$set')
+        with self.lock:
+            self._count_change(user_id)
+            entry = self.entries.get(user_id)
+            if entry is not None:
+                if set_fields is not None and len(update) == 1:
+                    user_object = dict(entry[0])
+                    user_object.update(set_fields)
+                    self.entries[user_id] = (user_object, entry[1])
+                else:
+                    del self.entries[user_id]
+        self._publish(user_id)
+
+    def forget(self, user_id):
+        with self.lock:
+            self._count_change(user_id)
+            self.entries.pop(user_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def _count_change(self, user_id):
+        read = self.reads.get(user_id)
+        if read is not None:
+            read[0] += 1
+
+    def _put(self, user_id, user_object):
+        with self.lock:
+            self._store(user_id, user_object)
+
+    def _store(self, user_id, user_object):
+        # the lock must be held
+        self.entries[user_id] = (user_object, time.monotonic() + self.ttl)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def _publish(self, user_id):
+        if self.channel is not None:
+            self.channel.publish(user_id)
+
+
+class InvalidationChannel:
+    """
+    Lets several worker processes share invalidations of their user caches.
+    Every write is announced in a small collection, which every process polls for announcements of the others.
+    """
+    def __init__(self, collection, poll_interval=1.0, overlap=5.0):
+        # user_id, origin, created_at
+        self.collection = collection
+        self.poll_interval = poll_interval
+        self.overlap = timedelta(seconds=overlap)
+        self.origin = str(uuid.uuid4())
+        self.callbacks = []
+        self.seen = {}
+        self.thread = None
+
+    def subscribe(self, callback):
+        self.callbacks.append(callback)
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._poll, name='user-cache-invalidation', daemon=True)
+            self.thread.start()
+
+    def publish(self, user_id):
+        self.collection.insert_one({'user_id': user_id, 'origin': self.origin, 'created_at': datetime.utcnow()})
+
+    def _poll(self):
+        last_poll = datetime.utcnow()
+        while True:
+            time.sleep(self.poll_interval)
+            # re-read a few seconds back, because clocks and insertion order across processes are not exact
+            since = last_poll - self.overlap
+            last_poll = datetime.utcnow()
+            try:
+                announcements = list(self.collection.find(
+                    {'created_at': {'$gte': since}, 'origin': {'$ne': self.origin}},
+                    {'user_id': 1, 'created_at': 1},
+                ))
+            except Exception as exc:
+                logger.warning('failed to poll cache invalidations: %s', exc)
+                continue
+            for announcement in announcements:
+                if announcement['_id'] in self.seen:
+                    continue
+                self.seen[announcement['_id']] = announcement['created_at']
+                for callback in self.callbacks:
+                    callback(announcement['user_id'])
+            self.seen = {key: value for key, value in self.seen.items() if value >= since}
+
+
+def make_invalidation_channel(collection):
+    """ The channel over the user_cache_invalidations collection, if the invalidations are enabled """
+    if os.environ.get('USER_CACHE_INVALIDATION'):
+        return InvalidationChannel(collection)
+    return None
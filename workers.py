@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+BACKPRESSURE_BLOCK = 'block'
+BACKPRESSURE_REJECT = 'reject'
+
+
+class ShardedWorkerPool:
+    """
+    Processes items in parallel on several shards, each served by its own thread.
+    Items with the same key always go to the same shard, so they are processed in the order of submission.
+    When a shard queue is full, submit() either waits for up to block_timeout seconds (the "block" policy)
+    or fails right away (the "reject" policy); in both cases it returns False if the item was not accepted.
+    """
+    def __init__(
+            self, handler, num_shards=None, max_queue_size=1000, backpressure=BACKPRESSURE_BLOCK, block_timeout=5,
+            name='worker',
+    ):
+        if backpressure not in {BACKPRESSURE_BLOCK, BACKPRESSURE_REJECT}:
+            raise ValueError('Unknown backpressure policy "{}"'.format(backpressure))
+        self.handler = handler
+        self.num_shards = num_shards or 4 * (os.cpu_count() or 1)
+        self.backpressure = backpressure
+        self.block_timeout = block_timeout
+        self.name = name
+        self.queues = [queue.Queue(maxsize=max_queue_size) for _ in range(self.num_shards)]
+        self.threads = []
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for i, shard_queue in enumerate(self.queues):
+                thread = threading.Thread(
+                    target=self._work, args=(shard_queue,), name='{}-{}'.format(self.name, i), daemon=True
+                )
+                thread.start()
+                self.threads.append(thread)
+
+    def submit(self, key, item):
+        if not self.threads:
+            self.start()
+        shard_queue = self.queues[hash(key) % self.num_shards]
+        try:
+            if self.backpressure == BACKPRESSURE_BLOCK:
+                shard_queue.put(item, timeout=self.block_timeout)
+            else:
+                shard_queue.put_nowait(item)
+        except queue.Full:
+            self.rejected += 1
+            return False
+        return True
+
+    def queue_depth(self):
+        return sum(shard_queue.qsize() for shard_queue in self.queues)
+
+    def shard_depths(self):
+        return [shard_queue.qsize() for shard_queue in self.queues]
+
+    def join(self):
+        """ Block until every submitted item has been processed """
+        for shard_queue in self.queues:
+            shard_queue.join()
+
+    def stop(self):
+        self.join()
+        for shard_queue in self.queues:
+            shard_queue.put(None)
+        for thread in self.threads:
+            thread.join(timeout=1)
+        self.threads = []
+
+    def _work(self, shard_queue):
+        while True:
+            item = shard_queue.get()
+            try:
+                if item is None:
+                    return
+                self.handler(item)
+            except Exception:
+                logger.exception('failed to process an item in %s', self.name)
+            finally:
+                shard_queue.task_done()